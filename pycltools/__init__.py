@@ -17,8 +17,8 @@ __classifiers__ = [
 
 __install_requires__ = [
     "pysam>=0.14.0",
-    "pandas>=0.23.0",
-    "numpy>=1.14.0",
+    "pandas>=1.0.0",
+    "numpy>=1.17.0",
     "tqdm>=4.23.4",
     "matplotlib>=3.0.0",
 ]
@@ -5,13 +5,35 @@ import os
 import shutil
 import sys
 import gzip
+import bz2
+import lzma
+import io
+import zlib
+import mmap
 import random
-from collections import OrderedDict, defaultdict, Counter
+import struct
+import time
+import queue
+import threading
+import tempfile
+import signal
+import asyncio
+from collections import OrderedDict, defaultdict, Counter, deque
+import subprocess
 from subprocess import Popen, PIPE
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import bisect
+import json
 import itertools
 import glob
+import fnmatch
+import stat
 import re
+import xml.etree.ElementTree as ET
+import hashlib
+import urllib.request
+import urllib.parse
+import urllib.error
 from datetime import date
 
 # Third party imports
@@ -25,6 +47,83 @@ from matplotlib import pyplot as pl
 
 MAX_SEED_VALUE = 2**32
 
+# Log-scaled read length bin edges (20 bins per order of magnitude from 1 to 10 Mb)
+READ_LEN_BIN_EDGES = np.power(10, np.arange(141) / 20)
+
+# Alignment fields available in bam_read_chunks: (AlignedSegment attribute, numpy dtype, missing value)
+BAM_FIELDS = {
+    "qname": ("query_name", object, None),
+    "flag": ("flag", np.uint16, 0),
+    "ref": ("reference_id", np.int32, -1),
+    "pos": ("reference_start", np.int64, -1),
+    "end": ("reference_end", np.int64, -1),
+    "mapq": ("mapping_quality", np.uint8, 0),
+    "length": ("query_length", np.int64, 0),
+    "cigar": ("cigarstring", object, None),
+    "seq": ("query_sequence", object, None),
+}
+
+# Maximal age in seconds of the directory sizes cached by dir_size
+DU_CACHE_TTL = 60
+_DU_CACHE = {}
+
+# Time to live in seconds of the cached qstat snapshot, and the cache itself
+QSTAT_CACHE_TTL = 10
+_QSTAT_CACHE = {}
+
+# Scheduler backend used by qsub, qsub_array and qstat (see set_scheduler)
+_SCHEDULER = None
+
+# Minimal size of the segments downloaded in parallel by download
+DOWNLOAD_MIN_SEGMENT_SIZE = 32 * 2**20
+
+# Mapping of the qstat -xml job_list elements to qstat columns
+QSTAT_XML_TAGS = OrderedDict([
+    ("JB_job_number", "job-ID"),
+    ("JAT_prio", "prior"),
+    ("JB_name", "name"),
+    ("JB_owner", "user"),
+    ("state", "state"),
+    ("JAT_start_time", "submit/start_at"),
+    ("JB_submission_time", "submit/start_at"),
+    ("queue_name", "queue"),
+    ("slots", "slots"),
+    ("tasks", "ja-task-ID"),
+    ("full_job_name", "name"),
+])
+
+# Size of the chunks read or mapped at once by the byte-level file parsers
+BUF_SIZE = 1024 * 1024
+
+# Maximal uncompressed size of a BGZF block and empty BGZF block marking the end of the file
+BGZF_BLOCK_SIZE = 65280
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Minimal number of sampled runs of blocks to compute a bootstrap confidence interval in estimation mode
+SAMPLE_MIN_RUNS = 10
+
+# Leading bytes of compressed file formats
+COMPRESSION_MAGIC = OrderedDict(
+    [
+        ("gzip", b"\x1f\x8b"),
+        ("bz2", b"BZh"),
+        ("xz", b"\xfd7zXZ\x00"),
+        ("zstd", b"\x28\xb5\x2f\xfd"),
+    ]
+)
+
+# External multi-core decompression commands tried in order for each format
+EXTERNAL_DECOMPRESSORS = {
+    "gzip": [["pigz", "-dc"], ["gzip", "-dc"]],
+    "bgzf": [["bgzip", "-dc", "-@", "4"], ["pigz", "-dc"]],
+    "bz2": [["pbzip2", "-dc"], ["bzip2", "-dc"]],
+    "xz": [["xz", "-dc", "-T0"]],
+    "zstd": [["zstd", "-dc"]],
+}
+
+# If True, readers decompress files with EXTERNAL_DECOMPRESSORS when available
+USE_EXTERNAL_DECOMPRESSORS = False
+
 COLOR_CODES = {
     "white": 29,
     "grey": 30,
@@ -120,10 +219,26 @@ def is_readable_file(fp, raise_exception=True, **kwargs):
 
 def is_gziped(fp, **kwargs):
     """
-    Return True if the file is Gziped else False
+    Return True if the file is Gziped else False, based on the file name.
+    Used for output files. To inspect the content of an existing file see file_compression
     """
     return fp[-2:].lower() == "gz"
 
+def file_compression(fp, **kwargs):
+    """
+    Return the compression format of an existing file from its magic bytes: "gzip", "bgzf", "bz2", "xz", "zstd"
+    or None for uncompressed files
+    """
+    with open(fp, "rb") as fh:
+        header = fh.read(16)
+    for comp, magic in COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            # BGZF = gzip with an extra field starting with the BC subfield
+            if comp == "gzip" and len(header) >= 14 and header[3] & 4 and header[12:14] == b"BC":
+                return "bgzf"
+            return comp
+    return None
+
 def has_extension(fp, ext, pos=-1, raise_exception=False, **kwargs):
     """
     Test presence of extension in a file path
@@ -229,23 +344,174 @@ def rm_blank(name, replace="", **kwargs):
 
 # ~~~~~~~ FILE MANIPULATION ~~~~~~~#
 
-def concatenate(src_list, dest, **kwargs):
+def open_file(fp, mode="rt", external=None, **kwargs):
+    """
+    Open a file for reading, whatever its compression. The format is detected from the magic bytes
+    (gzip, bgzf, bz2, xz, zstd or uncompressed). Can be used as a context manager
+    * fp
+        Path of the file to open
+    * mode
+        "rt" or "r" for text, "rb" for binary
+    * external
+        If True decompress in a subprocess with the first available command of EXTERNAL_DECOMPRESSORS
+        (eg pigz or zstd), which runs on other cores. Fall back to python if no command is found.
+        Default to USE_EXTERNAL_DECOMPRESSORS
+    """
+    if mode not in ("r", "rt", "rb"):
+        raise ValueError("open_file only opens files for reading")
+    if external is None:
+        external = USE_EXTERNAL_DECOMPRESSORS
+    text = "b" not in mode
+    comp = file_compression(fp)
+
+    if not comp:
+        return open(fp, "r" if text else "rb")
+
+    if external or comp == "zstd":
+        for cmd in EXTERNAL_DECOMPRESSORS.get(comp, []):
+            if shutil.which(cmd[0]):
+                return _PipeReader(cmd + [fp], text=text)
+
+    if comp in ("gzip", "bgzf"):
+        open_fun = gzip.open
+    elif comp == "bz2":
+        open_fun = bz2.open
+    elif comp == "xz":
+        open_fun = lzma.open
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading zstd files requires the zstandard package or the zstd command")
+        open_fun = zstandard.open
+    return open_fun(fp, "rt" if text else "rb")
+
+class _PipeReader:
+    """
+    File-like reader over the standard output of a decompression subprocess
+    """
+    def __init__(self, cmd, text=True):
+        self.cmd = cmd
+        # stderr goes to a temporary file so that a verbose decompressor can never block on a full pipe
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = Popen(cmd, stdout=PIPE, stderr=self.stderr)
+        self.fh = io.TextIOWrapper(self.proc.stdout) if text else self.proc.stdout
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.fh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # Closing the pipe stops a process whose output was not fully read (SIGPIPE)
+        self.fh.close()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.terminate()
+            self.proc.wait()
+        self.stderr.seek(0)
+        err = self.stderr.read().decode(errors="replace").strip()
+        self.stderr.close()
+        # A negative return code means that the process was stopped by a signal after an early close
+        if self.proc.returncode > 0:
+            raise IOError(
+                "{} exited with code {}: {}".format(" ".join(self.cmd), self.proc.returncode, err)
+            )
+
+def _iter_chunks(fp, buf_size=BUF_SIZE, comp=False):
     """
-    Concatenate a list of scr files in a single output file. Handle gziped files (mixed input and output)
+    Yield uncompressed binary chunks from a file whatever its compression.
+    Gziped files are decompressed directly with zlib unless external decompressors are enabled
     """
-    if is_gziped(dest):
-        open_fun_dest, open_mode_dest = gzip.open, "wt"
+    if comp is False:
+        comp = file_compression(fp)
+    if comp in ("gzip", "bgzf") and not USE_EXTERNAL_DECOMPRESSORS:
+        yield from _iter_gzip_chunks(fp, buf_size)
     else:
-        open_fun_dest, open_mode_dest = open, "w"
-    with open_fun_dest(dest, open_mode_dest) as fh_dest:
+        with open_file(fp, "rb") as fh:
+            read_f = fh.read  # loop optimization
+            buf = read_f(buf_size)
+            while buf:
+                yield buf
+                buf = read_f(buf_size)
+
+def concatenate(src_list, dest, **kwargs):
+    """
+    Concatenate a list of scr files in a single output file. Handle compressed files (mixed input and output)
+    Files are copied byte for byte without recompression if the source and the destination are both gziped
+    (concatenated gzip members are a valid gzip file) or both uncompressed. Files are only transcoded if the
+    formats differ.
+    """
+    dest_gz = is_gziped(dest)
+    with open(dest, "wb") as fh_dest:
         for src in src_list:
-            if is_gziped(src):
-                open_fun_src, open_mode_src = gzip.open, "rt"
-            else:
-                open_fun_src, open_mode_src = open, "r"
-            with open_fun_src(src, open_mode_src) as fh_src:
-                shutil.copyfileobj(fh_src, fh_dest)
+            _append_file(src, fh_dest, dest_gz)
+
+def _append_file(src, fh_dest, dest_gz):
+    """
+    Append a file at the end of an open binary file handle, transcoding only if the compression differs
+    """
+    comp = file_compression(src)
+    if _same_compression(comp, dest_gz):
+        _copy_raw(src, fh_dest)
+    elif dest_gz:
+        with gzip.GzipFile(fileobj=fh_dest, mode="wb") as gz_dest:
+            for chunk in _iter_chunks(src, comp=comp):
+                gz_dest.write(chunk)
+    else:
+        for chunk in _iter_chunks(src, comp=comp):
+            fh_dest.write(chunk)
+
+def _same_compression(comp, dest_gz):
+    """
+    Return True if a file with compression comp can be copied byte for byte in a gziped (dest_gz) or plain file
+    """
+    return comp in ("gzip", "bgzf") if dest_gz else not comp
+
+def _copy_raw(src, fh_dest):
+    """
+    Copy a file at the end of an open binary file handle in kernel space with copy_file_range or sendfile
+    when available, and fall back to a buffered copy
+    """
+    fh_dest.flush()
+    dest_fd = fh_dest.fileno()
+    with open(src, "rb") as fh_src:
+        src_fd = fh_src.fileno()
+        size = os.fstat(src_fd).st_size
+        copy_fun_list = []
+        if hasattr(os, "copy_file_range"):
+            copy_fun_list.append(lambda offset, count: os.copy_file_range(src_fd, dest_fd, count, offset))
+        if hasattr(os, "sendfile"):
+            copy_fun_list.append(lambda offset, count: os.sendfile(dest_fd, src_fd, offset, count))
+
+        copied = 0
+        for copy_fun in copy_fun_list:
+            try:
+                while copied < size:
+                    n = copy_fun(copied, size - copied)
+                    if not n:
+                        break
+                    copied += n
+                if copied >= size:
+                    return
+            # eg. not supported by the file system
+            except OSError:
+                continue
 
+        # Buffered copy of the remaining data
+        fh_src.seek(copied)
+        shutil.copyfileobj(fh_src, fh_dest, BUF_SIZE)
 
 def copyFile(src, dest, **kwargs):
     """
@@ -264,13 +530,21 @@ def copyFile(src, dest, **kwargs):
     except IOError as E:
         print("Error: %s" % E.strerror)
 
-def gzip_file(fpin, fpout=None, keep_source=False, **kwargs):
+def gzip_file(
+    fpin, fpout=None, keep_source=False, level=9, threads=1, bgzf=False, **kwargs
+):
     """
-    gzip a file
+    gzip a file. The file is streamed by chunks so the memory usage does not depend on the file size
     * fpin
         Path of the input uncompressed file
     * fpout
         Path of the output compressed file (facultative)
+    * level
+        Compression level from 1 (fastest) to 9 (smallest)
+    * threads
+        Number of threads used to compress independent blocks in parallel (pigz-style multi-member output)
+    * bgzf
+        If True write a blocked gzip file (BGZF) that can be indexed by pysam, samtools or tabix
     """
     # Generate a automatic name if none is given
     if not fpout:
@@ -278,14 +552,21 @@ def gzip_file(fpin, fpout=None, keep_source=False, **kwargs):
 
     # Try to initialize handle for
     try:
-        in_handle = open(fpin, "rb")
-        out_handle = gzip.open(fpout, "wb")
-        # Write input file in output file
         print("Compressing {}".format(fpin))
-        out_handle.write(in_handle.read())
-        # Close both files
-        in_handle.close()
-        out_handle.close()
+        stime = time.time()
+        with open(fpin, "rb") as in_handle, open(fpout, "wb") as out_handle:
+            if bgzf:
+                block_iter = iter(lambda: in_handle.read(BGZF_BLOCK_SIZE), b"")
+                _write_blocks(out_handle, block_iter, _bgzf_block, level, threads)
+                out_handle.write(BGZF_EOF)
+            elif threads > 1:
+                block_iter = iter(lambda: in_handle.read(BUF_SIZE), b"")
+                _write_blocks(out_handle, block_iter, _gzip_block, level, threads)
+            else:
+                with gzip.GzipFile(fileobj=out_handle, mode="wb", compresslevel=level) as gz_handle:
+                    shutil.copyfileobj(in_handle, gz_handle, BUF_SIZE)
+        _print_throughput(fpin, stime)
+
         if not keep_source:
             remove_file(fpin)
 
@@ -301,7 +582,7 @@ def gzip_file(fpin, fpout=None, keep_source=False, **kwargs):
 
 def gunzip_file(fpin, fpout=None, keep_source=False, **kwargs):
     """
-    ungzip a file
+    ungzip a file. The file is streamed by chunks so the memory usage does not depend on the file size
     * fpin
         Path of the input compressed file
     * fpout
@@ -312,21 +593,19 @@ def gunzip_file(fpin, fpout=None, keep_source=False, **kwargs):
         fpout = fpin[0:-3]
 
     try:
-        # Try to initialize handle for
-        in_handle = gzip.GzipFile(fpin, "rb")
-        out_handle = open(fpout, "wb")
-        # Write input file in output file
         print("Uncompressing {}".format(fpin))
-        out_handle.write(in_handle.read())
-        # Close both files
-        out_handle.close()
-        in_handle.close()
+        stime = time.time()
+        with open(fpout, "wb") as out_handle:
+            for chunk in _iter_gzip_chunks(fpin):
+                out_handle.write(chunk)
+        _print_throughput(fpout, stime)
+
         if not keep_source:
             remove_file(fpin)
 
         return os.path.abspath(fpout)
 
-    except IOError as E:
+    except (IOError, EOFError, zlib.error) as E:
         print(E)
         if os.path.isfile(fpout):
             try:
@@ -334,6 +613,46 @@ def gunzip_file(fpin, fpout=None, keep_source=False, **kwargs):
             except OSError:
                 print("Can't remove {}".format(fpout))
 
+def _write_blocks(out_handle, block_iter, compress_fun, level=9, threads=1):
+    """
+    Compress blocks with a thread pool and write them in order. The number of blocks in flight is bounded
+    """
+    max_pending = max(threads, 1) * 4
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        pending = []
+        for block in block_iter:
+            pending.append(executor.submit(compress_fun, block, level))
+            if len(pending) >= max_pending:
+                out_handle.write(pending.pop(0).result())
+        for future in pending:
+            out_handle.write(future.result())
+
+def _gzip_block(data, level=9):
+    """
+    Compress a block of data as an independent gzip member
+    """
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+def _bgzf_block(data, level=9):
+    """
+    Compress a block of data (max 65280 bytes) as a BGZF block
+    """
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = comp.compress(data) + comp.flush()
+    # Gzip header with BC extra field containing the total block size - 1
+    header = struct.pack(
+        "<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25
+    )
+    return header + cdata + struct.pack("<2I", zlib.crc32(data), len(data))
+
+def _print_throughput(fp, stime):
+    """
+    Print the processing speed in MB/s based on the size of the uncompressed file
+    """
+    duration = max(time.time() - stime, 1e-6)
+    size = os.path.getsize(fp) / 1e6
+    print("{:.1f} MB processed in {:.2f} s ({:.1f} MB/s)".format(size, duration, size / duration))
+
 def remove_file(fp, exception_if_exist=False):
     """
     Try to remove a file from disk.
@@ -344,84 +663,254 @@ def remove_file(fp, exception_if_exist=False):
         if exception_if_exist:
             raise E
 
-def super_iglob (pathname, recursive=False, regex_list=[]):
-    """ Same as iglob but pass multiple path regex instead of one. does not store anything in memory"""
+def super_iglob (pathname, recursive=False, regex_list=[], threads=4):
+    """
+    Same as iglob but pass multiple path regex instead of one. does not store anything in memory
+    Directories matched by pathname are scanned with os.scandir, reusing the file type information of the directory
+    entries, and all the regex of regex_list are compiled in a single matcher. Matches are yielded lazily, once each
+    and in a stable order (sorted by name, matches of a directory before the content of its subdirectories).
+    * pathname
+        Glob pattern or list of patterns
+    * recursive
+        If True, regex starting with "**/" also match files in all subdirectories (as with glob). Other patterns
+        containing "**" are expanded with glob
+    * regex_list
+        List of file name patterns (eg ["*.fastq", "*.fq.gz"]) searched in the directories matched by pathname.
+        Patterns containing other directory separators are expanded with glob
+    * threads
+        Number of threads used to scan subdirectories concurrently in recursive mode
+    """
     if type(pathname) == str:
         pathname = [pathname]
 
-    if type(pathname) in [list, tuple, set]:
+    if not type(pathname) in [list, tuple, set]:
+        raise ValueError ("Invalid file type")
+
+    # Split simple name patterns from patterns with directory parts
+    name_regex_list = []
+    deep_regex_list = []
+    path_regex_list = []
+    for regex in regex_list:
+        if recursive and regex.startswith("**/") and not "/" in regex[3:] and not "**" in regex[3:]:
+            deep_regex_list.append(regex[3:])
+        elif "/" in regex or (recursive and "**" in regex):
+            path_regex_list.append(regex)
+        else:
+            name_regex_list.append(regex)
+    name_matcher = _compile_name_matcher(name_regex_list + deep_regex_list)
+    deep_matcher = _compile_name_matcher(deep_regex_list)
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
         for paths in pathname:
-            for path in glob.iglob(pathname=paths, recursive=recursive):
-                if os.path.isdir(path) and regex_list:
-                    for regex in regex_list:
+            for path in sorted(glob.iglob(pathname=paths, recursive=recursive)):
+                try:
+                    mode = os.stat(path).st_mode
+                except OSError:
+                    continue
+                if stat.S_ISDIR(mode) and regex_list:
+                    if name_matcher:
+                        future = executor.submit(_scan_dir, path, name_matcher)
+                        yield from _walk_scans(executor, future, deep_matcher)
+                    for regex in path_regex_list:
                         regex_paths = os.path.join(path, regex)
                         for regex_path in glob.iglob(pathname=regex_paths, recursive=recursive):
                             yield regex_path
-                elif os.path.isfile(path):
+                elif stat.S_ISREG(mode):
                     yield path
-    else:
-        raise ValueError ("Invalid file type")
 
-def fastq_merge (src_dir, dest_fn, progress=True):
+def _compile_name_matcher(regex_list):
+    """
+    Compile a list of glob style file name patterns in a single matcher. As with glob, hidden files
+    only match patterns starting with a dot. Return a (visible matcher, hidden matcher) tuple or None
+    """
+    if not regex_list:
+        return None
+    hidden_list = [r for r in regex_list if r.startswith(".")]
+    visible = re.compile("|".join(fnmatch.translate(r) for r in regex_list))
+    hidden = re.compile("|".join(fnmatch.translate(r) for r in hidden_list)) if hidden_list else None
+    return visible, hidden
+
+def _scan_dir(path, matcher):
+    """
+    Scan a directory once. Return the sorted lists of entries matching the matcher (files or directories, as with
+    glob) and of visible subdirectories
+    """
+    visible, hidden = matcher
+    file_list = []
+    dir_list = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name
+                is_hidden = name.startswith(".")
+                is_dir = entry.is_dir()
+                if is_dir and not is_hidden:
+                    dir_list.append(entry.path)
+                name_re = hidden if is_hidden else visible
+                if name_re and name_re.match(name) and (is_dir or entry.is_file()):
+                    file_list.append(entry.path)
+    except OSError:
+        pass
+    return sorted(file_list), sorted(dir_list)
+
+def _walk_scans(executor, future, deep_matcher):
+    """
+    Yield the matches of a scanned directory, then recursively those of its subdirectories matching deep_matcher.
+    The subdirectories are scanned ahead by the thread pool
+    """
+    file_list, dir_list = future.result()
+    yield from file_list
+    if deep_matcher:
+        sub_future_list = [executor.submit(_scan_dir, d, deep_matcher) for d in dir_list]
+        for sub_future in sub_future_list:
+            yield from _walk_scans(executor, sub_future, deep_matcher)
+
+def fastq_merge (src_dir, dest_fn, progress=True, workers=4, queue_size=8):
+    """
+    Concatenate a list of scr files in a single output file. Handle compressed files (mixed input and output)
+    Sources are prefetched and transcoded if needed concurrently by a pool of workers, and written in the
+    order of super_iglob by a single writer. Memory usage is bounded to workers * queue_size chunks of 1MB
+    * src_dir
+        Directory, glob pattern or list of patterns containing fastq files
+    * dest_fn
+        Path of the output fastq file. Compressed if it ends with gz
+    * workers
+        Number of sources read concurrently
+    * queue_size
+        Maximal number of chunks buffered per source
+    """
+    dest_gz = is_gziped(dest_fn)
+    src_iter = super_iglob (src_dir, regex_list=["*.fastq","*.fq","*.fastq.gz","*.fq.gz"])
+    stop_event = threading.Event()
+    active = deque()
+
+    with open(dest_fn, "wb") as dest_fp, tqdm(desc="Files processed ", unit=" files", disable= not progress) as pb:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    # Keep the pool busy with the next sources
+                    while len(active) < workers:
+                        src = next(src_iter, None)
+                        if src is None:
+                            break
+                        chunk_queue = queue.Queue(maxsize=queue_size)
+                        future = executor.submit(_prefetch_file, src, dest_gz, chunk_queue, stop_event)
+                        active.append((chunk_queue, future))
+                    if not active:
+                        break
+
+                    # Write the oldest source
+                    chunk_queue, future = active.popleft()
+                    for chunk in iter(chunk_queue.get, None):
+                        dest_fp.write(chunk)
+                    future.result()
+                    pb.update(1)
+
+            # Release blocked workers before shutting down the pool
+            except BaseException:
+                stop_event.set()
+                raise
+
+def _prefetch_file(src, dest_gz, chunk_queue, stop_event):
+    """
+    Read a source file by chunks transcoded to match the destination compression and put them in a queue.
+    None is always put at the end to signal the end of the file
+    """
+    chunk_iter = _iter_transcoded(src, dest_gz)
+    try:
+        for chunk in chunk_iter:
+            if not _queue_put(chunk_queue, chunk, stop_event):
+                return
+    finally:
+        chunk_iter.close()
+        _queue_put(chunk_queue, None, stop_event)
+
+def _iter_transcoded(src, dest_gz):
     """
-    Concatenate a list of scr files in a single output file. Handle gziped files (mixed input and output)
-    """ 
-    if is_gziped(dest_fn):
-        open_fun_dest, open_mode_dest = gzip.open, "wt"
+    Yield binary chunks of a file, decompressed or compressed as independent gzip members to match dest_gz
+    """
+    comp = file_compression(src)
+    if _same_compression(comp, dest_gz):
+        with open(src, "rb") as fh:
+            yield from iter(lambda: fh.read(BUF_SIZE), b"")
+    elif dest_gz:
+        for chunk in _iter_chunks(src, comp=comp):
+            yield _gzip_block(chunk)
     else:
-        open_fun_dest, open_mode_dest = open, "w"
-    
-    with open_fun_dest(dest_fn, open_mode_dest) as dest_fp, tqdm(desc="Files processed ", unit=" files", disable= not progress) as pb:
-        for src in super_iglob (src_dir, regex_list=["*.fastq","*.fq","*.fastq.gz","*.fq.gz"]):
-            if is_gziped(src):
-                open_fun_src, open_mode_src = gzip.open, "rt"
-            else:
-                open_fun_src, open_mode_src = open, "r"
-            with open_fun_src(src, open_mode_src) as src_fp:
-                shutil.copyfileobj(src_fp, dest_fp)
-                pb.update(1)
+        yield from _iter_chunks(src, comp=comp)
+
+def _queue_put(q, item, stop_event, timeout=1):
+    """
+    Put an item in a bounded queue unless stop_event is set. Return False if stopped
+    """
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+    return False
 
 # ~~~~~~~ FILE INFORMATION/PARSING ~~~~~~~#
 
-def linerange(fp, range_list=[], line_numbering=True, max_char_line=150, **kwargs):
+def linerange(
+    fp, range_list=[], line_numbering=True, max_char_line=150, index=False, **kwargs
+):
     """
-    Print a range of lines in a file according to a list of start end lists. Handle gziped files
+    Print a range of lines in a file according to a list of start end lists. Handle compressed files (see open_file)
     * fp
         Path to the file to be parsed
     * range_list
-        list of start, end coordinates lists or tuples
+        list of start, end coordinates lists or tuples. If not given the 3 first and 3 last lines are printed
     * line_numbering
-        If True the number of the line will be indicated in front of the line
+        If True the number of the line will be indicated in front of the line. Without range_list, the last lines
+        of uncompressed files are numbered from the end (-3, -2, -1) unless an index gives the line count, so that
+        only the beginning and the end of the file are read
     * max_char_line
         Maximal number of character to print per line
+    * index
+        If True use (and create if needed) a sidecar line index to jump directly to the requested lines.
+        See line_index
     """
+    idx = line_index(fp) if index else None
+
     if not range_list:
-        n_line = fastcount(fp)
+        # Uncompressed files: read the last lines from the end of the file
+        if not file_compression(fp):
+            _print_head_tail(
+                fp=fp,
+                n_head=3,
+                n_tail=3,
+                line_numbering=line_numbering,
+                max_char_line=max_char_line,
+                idx=idx,
+                relative_tail=True,
+            )
+            return
+        n_line = _line_count(fp, idx)
         range_list = [[0, 2], [n_line - 3, n_line - 1]]
 
-    if is_gziped(fp):
-        open_fun = gzip.open
-        open_mode = "rt"
-    else:
-        open_fun = open
-        open_mode = "r"
+    # Jump to each range with the index
+    if idx:
+        prev_end = -1
+        for start, end in sorted(range_list):
+            start = max(int(start), prev_end + 1, 0)
+            if start > end:
+                continue
+            if start > prev_end + 1:
+                print("...")
+            for n, line in _indexed_lines(fp, idx, start, end):
+                _print_line(line, n, line_numbering, max_char_line)
+                prev_end = n
+        return
 
-    with open_fun(fp, open_mode) as f:
+    with open_file(fp, "rt") as f:
         previous_line_empty = False
         for n, line in enumerate(f):
             line_print = False
             for start, end in range_list:
                 if start <= n <= end:
-                    if line_numbering:
-                        l = "{}\t{}".format(n, line.rstrip())
-                    else:
-                        l = line.rstrip()
-
-                    if max_char_line and len(l) > max_char_line:
-                        print(l[0:max_char_line] + "...")
-                    else:
-                        print(l)
-
+                    _print_line(line, n, line_numbering, max_char_line)
                     line_print = True
                     previous_line_empty = False
                     break
@@ -431,9 +920,9 @@ def linerange(fp, range_list=[], line_numbering=True, max_char_line=150, **kwarg
                     print("...")
                     previous_line_empty = True
 
-def cat(fp, max_lines=100, line_numbering=False, max_char_line=150, **kwargs):
+def cat(fp, max_lines=100, line_numbering=False, max_char_line=150, index=False, **kwargs):
     """
-    Emulate linux cat cmd but with line cap protection. Handle gziped files
+    Emulate linux cat cmd but with line cap protection. Handle compressed files (see open_file)
     * fp
         Path to the file to be parsed
     * max_lines
@@ -442,8 +931,24 @@ def cat(fp, max_lines=100, line_numbering=False, max_char_line=150, **kwargs):
         If True the number of the line will be indicated in front of the line
     * max_char_line
         Maximal number of character to print per line
+    * index
+        If True use (and create if needed) a sidecar line index. See line_index
     """
-    n_line = fastcount(fp)
+    idx = line_index(fp) if index else None
+
+    # Uncompressed files: read the last lines from the end of the file
+    if not file_compression(fp):
+        _print_head_tail(
+            fp=fp,
+            n_head=max_lines // 2,
+            n_tail=max_lines - max_lines // 2,
+            line_numbering=line_numbering,
+            max_char_line=max_char_line,
+            idx=idx,
+        )
+        return
+
+    n_line = _line_count(fp, idx)
     if n_line <= max_lines:
         range_list = [[0, n_line - 1]]
     else:
@@ -453,11 +958,14 @@ def cat(fp, max_lines=100, line_numbering=False, max_char_line=150, **kwargs):
         range_list=range_list,
         line_numbering=line_numbering,
         max_char_line=max_char_line,
+        index=index,
     )
 
-def tail(fp, n=10, line_numbering=False, max_char_line=150, **kwargs):
+def tail(fp, n=10, line_numbering=False, max_char_line=150, index=False, **kwargs):
     """
-    Emulate linux tail cmd. Handle gziped files
+    Emulate linux tail cmd. Handle compressed files (see open_file)
+    Uncompressed files are read backward from the end, without parsing the whole file. Compressed files are streamed
+    once, keeping only the last n lines in memory
     * fp
         Path to the file to be parsed
     * n
@@ -466,19 +974,236 @@ def tail(fp, n=10, line_numbering=False, max_char_line=150, **kwargs):
         If True the number of the line will be indicated in front of the line
     * max_char_line
         Maximal number of character to print per line
+    * index
+        If True use (and create if needed) a sidecar line index. See line_index
     """
-    n_line = fastcount(fp)
-    if n_line <= n:
-        range_list = [[0, n_line]]
-        print("Only {} lines in the file".format(n_line))
+    idx = line_index(fp) if index else None
+
+    if not file_compression(fp):
+        line_list = _tail_lines(fp, n)
+        if len(line_list) < n:
+            print("Only {} lines in the file".format(len(line_list)))
+        # Line numbers are only known if the file is counted
+        first_line = _plain_line_count(fp, idx) - len(line_list) if line_numbering else 0
+        for i, line in enumerate(line_list):
+            _print_line(line, first_line + i, line_numbering, max_char_line)
+        return
+
+    # Compressed files: keep the last lines while streaming the file or from the closest index checkpoint
+    if idx:
+        line_list = deque(_indexed_lines(fp, idx, max(idx["n_lines"] - n, 0), idx["n_lines"]), maxlen=n)
     else:
-        range_list = [[n_line - n + 1, n_line]]
-    linerange(
-        fp=fp,
-        range_list=range_list,
-        line_numbering=line_numbering,
-        max_char_line=max_char_line,
-    )
+        with open_file(fp, "rt") as fh:
+            line_list = deque(enumerate(fh), maxlen=n)
+    if len(line_list) < n:
+        print("Only {} lines in the file".format(len(line_list)))
+    for i, line in line_list:
+        _print_line(line, i, line_numbering, max_char_line)
+
+def line_index(fp, step=1000, rebuild=False, **kwargs):
+    """
+    Load the sidecar line index of a file (fp + ".lidx"), or create it if it does not exist or is outdated.
+    The index is automatically rebuilt when the size or the modification time of the file changes.
+    For uncompressed files the byte offset of every step-th line is stored. For gziped files, checkpoints
+    are stored at gzip member boundaries (bgzip or concatenated gzip files), from where decompression can restart.
+    Single member gzip files only get a checkpoint at the start of the file, but still store the line count.
+    * fp
+        Path to the file to be indexed
+    * step
+        Minimal number of lines between 2 checkpoints
+    * rebuild
+        Force the index to be rebuilt
+    """
+    comp = file_compression(fp)
+    if comp not in (None, "gzip", "bgzf"):
+        raise ValueError("Line index is not supported for {} files".format(comp))
+
+    idx_fn = fp + ".lidx"
+    st = os.stat(fp)
+
+    if not rebuild and os.path.isfile(idx_fn):
+        try:
+            with open(idx_fn, "r") as fh:
+                idx = json.load(fh)
+            if (
+                idx["size"] == st.st_size
+                and idx["mtime"] == st.st_mtime_ns
+                and idx["step"] == step
+            ):
+                return idx
+        except (ValueError, KeyError):
+            pass
+
+    if comp:
+        n_lines, points = _gzip_line_points(fp, step)
+    else:
+        n_lines, points = _plain_line_points(fp, step)
+
+    idx = {
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "step": step,
+        "n_lines": n_lines,
+        "points": points,
+    }
+    with open(idx_fn, "w") as fh:
+        json.dump(idx, fh)
+    return idx
+
+def _plain_line_points(fp, step):
+    """
+    Return the line count and [line, byte offset, partial] checkpoints of every step-th line of an uncompressed file
+    """
+    points = [[0, 0, 0]]
+    n_lines = 0
+    offset = 0
+    with open(fp, "rb") as fh:
+        for buf in iter(lambda: fh.read(BUF_SIZE), b""):
+            nl_pos = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+            # Line numbers starting just after each newline
+            line_num = np.arange(n_lines + 1, n_lines + 1 + len(nl_pos))
+            for i in np.flatnonzero(line_num % step == 0):
+                points.append([int(line_num[i]), offset + int(nl_pos[i]) + 1, 0])
+            n_lines += len(nl_pos)
+            offset += len(buf)
+    return n_lines, points
+
+def _gzip_line_points(fp, step):
+    """
+    Return the line count and [line, compressed offset, partial] checkpoints at gzip member boundaries
+    """
+    points = [[0, 0, 0]]
+    n_lines = 0
+    comp_offset = 0
+    with open(fp, "rb") as fh:
+        decomp = zlib.decompressobj(wbits=31)
+        last_byte = b"\n"
+        buf = fh.read(BUF_SIZE)
+        while buf:
+            for chunk in _inflate(decomp, buf):
+                n_lines += chunk.count(b"\n")
+                last_byte = chunk[-1:]
+            if decomp.eof:
+                # Start of next member
+                comp_offset += len(buf) - len(decomp.unused_data)
+                buf = decomp.unused_data or fh.read(BUF_SIZE)
+                decomp = zlib.decompressobj(wbits=31)
+                if buf and n_lines - points[-1][0] >= step:
+                    # If the member starts in the middle of a line the first line is skipped
+                    partial = int(last_byte != b"\n")
+                    points.append([n_lines + partial, comp_offset, partial])
+            else:
+                comp_offset += len(buf)
+                buf = fh.read(BUF_SIZE)
+    return n_lines, points
+
+def _indexed_lines(fp, idx, start, end):
+    """
+    Yield (line number, line) from start to end (included) using the closest checkpoint of a line index
+    """
+    points = idx["points"]
+    line, offset, partial = points[bisect.bisect_right([p[0] for p in points], start) - 1]
+
+    with open(fp, "rb") as raw:
+        raw.seek(offset)
+        fh = gzip.GzipFile(fileobj=raw, mode="rb") if file_compression(fp) else raw
+        if partial:
+            fh.readline()
+        for n, l in enumerate(fh, line):
+            if n > end:
+                break
+            if n >= start:
+                yield n, l.decode()
+
+def _line_count(fp, idx=None):
+    """
+    Return the number of lines from a line index if available or count them
+    """
+    return idx["n_lines"] if idx else fastcount(fp)
+
+def _plain_line_count(fp, idx=None):
+    """
+    Return the number of lines of an uncompressed file, including a last line without final newline
+    """
+    n_lines = _line_count(fp, idx)
+    with open(fp, "rb") as fh:
+        if fh.seek(0, os.SEEK_END) == 0:
+            return n_lines
+        fh.seek(-1, os.SEEK_END)
+        return n_lines + (fh.read(1) != b"\n")
+
+def _print_line(line, n, line_numbering=False, max_char_line=150):
+    """
+    Print a single line with optional line number and character cap
+    """
+    if line_numbering:
+        l = "{}\t{}".format(n, line.rstrip())
+    else:
+        l = line.rstrip()
+
+    if max_char_line and len(l) > max_char_line:
+        print(l[0:max_char_line] + "...")
+    else:
+        print(l)
+
+def _print_head_tail(
+    fp, n_head, n_tail, line_numbering=False, max_char_line=150, idx=None, relative_tail=False
+):
+    """
+    Print the first and last lines of an uncompressed file. The end of the file is read backward
+    so the cost does not depend on the file size, except if line_numbering requires a line count.
+    With relative_tail the last lines are numbered from the end of the file if no index is given, instead of counting
+    """
+    # Read 1 extra line to know if the whole file fits in the head
+    head_list = []
+    with open(fp, "r") as fh:
+        for line in fh:
+            head_list.append(line)
+            if len(head_list) > n_head + n_tail:
+                break
+
+    if len(head_list) <= n_head + n_tail:
+        for i, line in enumerate(head_list):
+            _print_line(line, i, line_numbering, max_char_line)
+        return
+
+    for i, line in enumerate(head_list[:n_head]):
+        _print_line(line, i, line_numbering, max_char_line)
+    print("...")
+    tail_list = _tail_lines(fp, n_tail)
+    if not line_numbering:
+        first_line = 0
+    elif relative_tail and not idx:
+        first_line = -len(tail_list)
+    else:
+        first_line = _plain_line_count(fp, idx) - len(tail_list)
+    for i, line in enumerate(tail_list):
+        _print_line(line, first_line + i, line_numbering, max_char_line)
+
+def _tail_lines(fp, n, block_size=64 * 1024):
+    """
+    Return the last n lines of an uncompressed file by reading blocks backward from the end of the file
+    """
+    if n <= 0:
+        return []
+    block_list = []
+    newlines = 0
+    with open(fp, "rb") as fh:
+        pos = fh.seek(0, os.SEEK_END)
+        # n + 1 newlines are required to make sure that the first line is complete
+        while pos > 0 and newlines <= n:
+            step = min(block_size, pos)
+            pos -= step
+            fh.seek(pos)
+            block = fh.read(step)
+            newlines += block.count(b"\n")
+            block_list.append(block)
+
+    line_list = b"".join(reversed(block_list)).split(b"\n")
+    # Ignore the final newline of the file
+    if line_list[-1] == b"":
+        line_list.pop()
+    return [l.decode() for l in line_list[-n:]]
 
 def head(
     fp,
@@ -491,7 +1216,7 @@ def head(
     **kwargs,
 ):
     """
-    Emulate linux head cmd. Handle gziped files and bam files
+    Emulate linux head cmd. Handle compressed files (see open_file) and bam files
     * fp
         Path to the file to be parsed. Works with text, gunziped and binary bam/sam files
     * n
@@ -522,15 +1247,8 @@ def head(
     # Not bam file
     else:
         # For text files
-        if is_gziped(fp):
-            open_fun = gzip.open
-            open_mode = "rt"
-        else:
-            open_fun = open
-            open_mode = "r"
-
         try:
-            with open_fun(fp, open_mode) as fh:
+            with open_file(fp, "rt") as fh:
                 line_num = 0
                 while line_num < n:
                     l = next(fh).rstrip()
@@ -586,65 +1304,314 @@ def head(
             print(l)
     print()
 
-def grep(fp, regex, max_lines=None):
+def grep(fp, regex, max_lines=None, invert=False, count=False, threads=1):
     """
-    Emulate linux head cmd. Handle gziped files and bam files
+    Emulate linux grep cmd. Handle compressed files (see open_file)
     * fp
-        Path to the file to be parsed. Works with text, gunziped and binary bam/sam files
+        Path to the file to be parsed. Works with text and compressed files
     * regex
         Linux style regular expression (https://docs.python.org/3.6/howto/regex.html#regex-howto)
         can also be a list, set or tuple of regex
     * max_lines
         Maximal number of line to print (Default None)
+    * invert
+        If True select non-matching lines
+    * count
+        If True return the number of selected lines instead of printing them
+    * threads
+        Number of processes used to search uncompressed files in parallel
     """
-    # Compile regular expression
-    if not type(regex) in (list, set, tuple):
-        regex_list = [re.compile(regex)]
-    else:
-        regex_list = [re.compile(r) for r in regex]
+    if count:
+        return _grep_count(fp, regex, invert=invert, threads=threads)
 
-    # For text files
-    if is_gziped(fp):
-        open_fun = gzip.open
-        open_mode = "rt"
+    found = 0
+    for _, _, line in grep_iter(fp, regex, invert=invert, threads=threads):
+        if max_lines and found == max_lines:
+            break
+        print(line)
+        found += 1
+
+def grep_iter(fp, regex, invert=False, threads=1):
+    """
+    Generator searching lines matching one or several regex in a file. Handle compressed files (see open_file)
+    The regex list is compiled in a single alternation and the search is done on bytes without decoding the file.
+    Uncompressed files can be split at line boundaries and searched in parallel.
+    Yield tuples (line number, byte offset, line). For compressed files the offset is in the uncompressed stream
+    * fp
+        Path to the file to be parsed. Works with text and compressed files
+    * regex
+        Linux style regular expression or list, set or tuple of regex
+    * invert
+        If True yield non-matching lines
+    * threads
+        Number of processes used to search uncompressed files in parallel.
+        Matches of each range are collected in memory before being yielded
+    """
+    pattern = _compile_regex_list(regex)
+
+    if threads > 1 and not file_compression(fp):
+        line_base = 0
+        for n_lines, match_list in _grep_parallel(fp, pattern, invert, False, threads):
+            for n, offset, line in match_list:
+                yield line_base + n, offset, line.decode(errors="replace")
+            line_base += n_lines
     else:
-        open_fun = open
-        open_mode = "r"
+        for n, offset, line in _grep_range(fp, pattern, invert):
+            yield n, offset, line.decode(errors="replace")
 
-    with open_fun(fp, open_mode) as fh:
-        found = 0
-        for line in fh:
-            if max_lines and found == max_lines:
+def _grep_count(fp, regex, invert=False, threads=1):
+    """
+    Count the number of lines matching (or not matching if invert) the regex without decoding lines
+    """
+    pattern = _compile_regex_list(regex)
+    if threads > 1 and not file_compression(fp):
+        return sum(c for _, c in _grep_parallel(fp, pattern, invert, True, threads))
+    return _grep_range_result(fp, pattern, invert, True)[1]
+
+def _compile_regex_list(regex):
+    """
+    Compile a regex or a list of regex in a single multiline bytes pattern
+    """
+    if not type(regex) in (list, set, tuple):
+        regex = [regex]
+    regex = [r.encode() if type(r) == str else r for r in regex]
+    if len(regex) == 1:
+        return re.compile(regex[0], re.MULTILINE)
+    return re.compile(b"|".join(b"(?:" + r + b")" for r in regex), re.MULTILINE)
+
+def _grep_parallel(fp, pattern, invert, count_only, threads):
+    """
+    Split an uncompressed file in ranges starting at line boundaries and search them with a process pool.
+    Return (number of lines, matches or count) for each range in file order
+    """
+    size = os.path.getsize(fp)
+    if not size:
+        return []
+    bounds = [0]
+    with open(fp, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, threads):
+            pos = mm.find(b"\n", max(size * i // threads, bounds[-1])) + 1
+            if pos <= 0:
                 break
-            for r in regex_list:
-                if r.search(line):
-                    print(line.rstrip())
-                    found += 1
-                    break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    if bounds[-1] != size:
+        bounds.append(size)
+
+    n = len(bounds) - 1
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        return list(
+            executor.map(
+                _grep_range_result,
+                [fp] * n,
+                [pattern] * n,
+                [invert] * n,
+                [count_only] * n,
+                bounds[:-1],
+                bounds[1:],
+            )
+        )
 
-def fastcount(fp, **kwargs):
+def _grep_range_result(fp, pattern, invert=False, count_only=False, start=0, end=None):
     """
-    Efficient way to count the number of lines in a file. Handle gziped files
+    Search a range of a file and return (number of lines, list of matches) or (number of lines, count)
     """
-    if is_gziped(fp):
-        open_fun = gzip.open
-        open_mode = "rt"
-    else:
-        open_fun = open
-        open_mode = "r"
+    n_lines = 0
+    n_match = 0
+    match_list = []
+    for offset, chunk in _iter_line_chunks(fp, start, end):
+        if count_only:
+            lines = chunk.count(b"\n") + (not chunk.endswith(b"\n"))
+            matches = sum(1 for _ in _grep_buffer(chunk, pattern))
+            n_match += lines - matches if invert else matches
+        else:
+            for n, ls, line in _grep_buffer(chunk, pattern, invert):
+                match_list.append((n_lines + n, offset + ls, line))
+        n_lines += chunk.count(b"\n") + (not chunk.endswith(b"\n"))
+    return n_lines, n_match if count_only else match_list
+
+def _grep_range(fp, pattern, invert=False, start=0, end=None):
+    """
+    Lazily yield (line number, byte offset, line bytes) matching a pattern in a range of a file
+    """
+    n_lines = 0
+    for offset, chunk in _iter_line_chunks(fp, start, end):
+        for n, ls, line in _grep_buffer(chunk, pattern, invert):
+            yield n_lines + n, offset + ls, line
+        n_lines += chunk.count(b"\n") + (not chunk.endswith(b"\n"))
+
+def _grep_buffer(buf, pattern, invert=False):
+    """
+    Yield (line index, line start, line bytes) of the lines of a buffer matching a pattern (or not if invert).
+    The buffer must start at the begining of a line and end at the end of a line
+    """
+    end = len(buf)
+    pos = 0
+    line_num = 0
+    while pos < end:
+        m = pattern.search(buf, pos)
+        if not m:
+            break
+        ls = buf.rfind(b"\n", pos, m.start()) + 1 or pos
+        # Empty match after the last newline
+        if ls >= end:
+            break
+        le = buf.find(b"\n", m.start())
+        if le == -1:
+            le = end
+        # Match spanning several lines: check the line in isolation
+        if m.end() > le and not pattern.search(buf, ls, le):
+            if invert:
+                yield from _iter_buffer_lines(buf, pos, le + 1, line_num)
+            line_num += buf.count(b"\n", pos, le + 1)
+            pos = le + 1
+            continue
+
+        if invert:
+            yield from _iter_buffer_lines(buf, pos, ls, line_num)
+            line_num += buf.count(b"\n", pos, ls)
+        else:
+            line_num += buf.count(b"\n", pos, ls)
+            yield line_num, ls, buf[ls:le]
+        line_num += 1
+        pos = le + 1
+
+    if invert:
+        yield from _iter_buffer_lines(buf, pos, end, line_num)
+
+def _iter_buffer_lines(buf, start, end, line_num):
+    """
+    Yield (line index, line start, line bytes) for all the lines of a buffer between start and end
+    """
+    while start < end:
+        le = buf.find(b"\n", start, end)
+        if le == -1:
+            le = end
+        yield line_num, start, buf[start:le]
+        line_num += 1
+        start = le + 1
+
+def _iter_line_chunks(fp, start=0, end=None, chunk_size=16 * BUF_SIZE):
+    """
+    Yield (byte offset, chunk) of a file cut at line boundaries. Uncompressed files are memory mapped and can be
+    restricted to a byte range. Compressed files are streamed, the offsets are in the uncompressed stream
+    """
+    if file_compression(fp):
+        offset = 0
+        remainder = b""
+        for buf in _iter_chunks(fp):
+            buf = remainder + buf
+            cut = buf.rfind(b"\n") + 1
+            if cut:
+                yield offset, buf[:cut]
+                offset += cut
+            remainder = buf[cut:]
+        if remainder:
+            yield offset, remainder
+        return
 
-    with open_fun(fp, open_mode) as fh:
+    size = os.path.getsize(fp)
+    end = size if end is None else min(end, size)
+    if start >= end:
+        return
+    with open(fp, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start < end:
+            cut = end
+            if start + chunk_size < end:
+                cut = mm.rfind(b"\n", start, start + chunk_size) + 1
+                # Line longer than the chunk size
+                if cut <= 0:
+                    cut = mm.find(b"\n", start + chunk_size, end) + 1 or end
+            yield start, mm[start:cut]
+            start = cut
+
+def fastcount(fp, threads=1, **kwargs):
+    """
+    Efficient way to count the number of lines in a file. Handle compressed files (see open_file)
+    Files are parsed as raw bytes without decoding. Uncompressed files are memory mapped and
+    can be split in byte ranges counted in parallel.
+    * fp
+        Path to the file to be parsed
+    * threads
+        Number of processes used to count newlines in uncompressed files (Default 1)
+    """
+    if file_compression(fp):
         lines = 0
-        buf_size = 1024 * 1024
-        read_f = fh.read  # loop optimization
+        for buf in _iter_chunks(fp):
+            lines += buf.count(b"\n")
+        return lines
 
-        buf = read_f(buf_size)
-        while buf:
-            lines += buf.count("\n")
-            buf = read_f(buf_size)
+    size = os.path.getsize(fp)
+    if threads <= 1 or size < threads * BUF_SIZE:
+        return _count_range(fp, 0, size)
+
+    # Split file in disjoint byte ranges
+    bounds = [size * i // threads for i in range(threads + 1)]
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        return sum(
+            executor.map(_count_range, [fp] * threads, bounds[:-1], bounds[1:])
+        )
 
+def _count_range(fp, start, end):
+    """
+    Count newlines between 2 byte positions of an uncompressed file using mmap
+    """
+    if end <= start:
+        return 0
+    lines = 0
+    with open(fp, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(start, end, BUF_SIZE):
+            lines += mm[i : min(i + BUF_SIZE, end)].count(b"\n")
     return lines
 
+def _inflate(decomp, buf, max_length=BUF_SIZE):
+    """
+    Yield the decompressed chunks of a compressed buffer, each at most max_length bytes long, so that highly
+    compressed data never inflates in memory at once
+    """
+    while True:
+        chunk = decomp.decompress(buf, max_length)
+        if chunk:
+            yield chunk
+        buf = decomp.unconsumed_tail
+        # Output may still be pending if the chunk filled max_length
+        if decomp.eof or (not buf and len(chunk) < max_length):
+            return
+
+def _iter_gzip_chunks(fp, buf_size=BUF_SIZE):
+    """
+    Yield decompressed binary chunks of at most buf_size bytes from a gziped file. Handle multi-member files
+    (concatenated gzip or bgzip).
+    NUL padding between or after members is skipped like in the gzip module. Raise EOFError if the file is truncated
+    """
+    with open(fp, "rb") as fh:
+        read_f = fh.read  # loop optimization
+        decomp = None
+        buf = read_f(buf_size)
+        while buf:
+            # Skip NUL padding before starting a new gzip member
+            if decomp is None:
+                buf = buf.lstrip(b"\x00")
+                if not buf:
+                    buf = read_f(buf_size)
+                    continue
+                decomp = zlib.decompressobj(wbits=31)
+            yield from _inflate(decomp, buf, buf_size)
+            # Start a new decompressor for the next gzip member
+            if decomp.eof:
+                buf = decomp.unused_data
+                decomp = None
+                if not buf:
+                    buf = read_f(buf_size)
+            else:
+                buf = read_f(buf_size)
+        if decomp is not None:
+            chunk = decomp.flush()
+            if chunk:
+                yield chunk
+            if not decomp.eof:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached: {}".format(fp))
+
 # ~~~~~~~ DIRECTORY MANIPULATION ~~~~~~~#
 
 def mkdir(
@@ -686,11 +1653,95 @@ def mkdir(
         os.makedirs(fp)
 
 def get_size_str(fp):
-    size = os.path.getsize(fp)
+    """
+    Return the size of a file as a human readable string
+    """
+    return _format_size(os.path.getsize(fp))
+
+def _format_size(size):
+    """
+    Format a size in bytes as a human readable string
+    """
     for limit, unit in ((1, "B"), (1e3, "KB"), (1e6, "MB"), (1e9, "GB"), (1e12, "TB")):
         s = size / limit
         if s < 1000:
             return f"{round(s, 3)} {unit}"
+    return f"{round(size / 1e12, 3)} TB"
+
+def dir_size(fp, threads=4, ttl=DU_CACHE_TTL):
+    """
+    Return the total size in bytes of the files in a directory and all its subdirectories (symlinks not followed).
+    Directories of each level are scanned concurrently with a thread pool. The sizes of the directory and all
+    its subdirectories are kept in a short-lived cache so that nested calls (eg tree with du) are immediate
+    * fp
+        Path of the directory
+    * threads
+        Number of threads used to scan directories
+    * ttl
+        Maximal age in seconds of cached sizes
+    """
+    fp = os.path.normpath(fp)
+    cached = _DU_CACHE.get(fp)
+    if cached and time.time() - cached[0] < ttl:
+        return cached[1]
+
+    own_size = OrderedDict()
+    children = {}
+    level = [fp]
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        while level:
+            next_level = []
+            for d, (size, subdir_list) in zip(level, executor.map(_scan_size, level)):
+                own_size[d] = size
+                children[d] = subdir_list
+                next_level.extend(subdir_list)
+            level = next_level
+
+    # Aggregate bottom-up, directories are in breadth first order
+    total = {}
+    for d in reversed(own_size):
+        total[d] = own_size[d] + sum(total[c] for c in children[d])
+
+    now = time.time()
+    for d, size in total.items():
+        _DU_CACHE[d] = (now, size)
+    return total[fp]
+
+def _scan_size(fp):
+    """
+    Return the size of the files directly in a directory and the list of its subdirectories
+    """
+    size = 0
+    subdir_list = []
+    try:
+        with os.scandir(fp) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdir_list.append(os.path.join(fp, entry.name))
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return size, subdir_list
+
+def _entry_info(entry, du=False, threads=4):
+    """
+    Return the color code and size string of a directory entry with a single stat call
+    """
+    try:
+        if entry.is_dir():
+            size = dir_size(entry.path, threads=threads) if du else entry.stat().st_size
+            return "34", _format_size(size)
+        if entry.is_file():
+            return "32", _format_size(entry.stat().st_size)
+        if entry.is_symlink():
+            return "31", _format_size(entry.stat(follow_symlinks=False).st_size)
+        return "37", _format_size(entry.stat(follow_symlinks=False).st_size)
+    except OSError:
+        return "37", "?"
 
 def tree(
     dir_fn=".",
@@ -699,67 +1750,71 @@ def tree(
     tab="  ",
     show_hidden=False,
     level=0,
+    du=False,
+    threads=4,
 ):
     """
     Print a directory arborescence
+    * du
+        If True also print the recursive size of directories (see dir_size)
+    * threads
+        Number of threads used to compute directory sizes
     """
     dir_fn = dir_fn.rstrip("/")
-    for dir_fn in glob.glob(dir_fn):
+    for dir_fn in glob.glob(dir_fn) if level == 0 else [dir_fn]:
         if not os.path.isdir(dir_fn):
             return
-        else:
-            if level == 0:
+        if level == 0:
+            if du:
+                print("\x1b[{}m{} [{}]\x1b[0m".format(34, os.path.basename(dir_fn), _format_size(dir_size(dir_fn, threads))))
+            else:
                 print("\x1b[{}m{}\x1b[0m".format(34, os.path.basename(dir_fn)))
 
-            dir_list = []
-            other_list = []
-            for fn in os.listdir(dir_fn):
-                if not show_hidden and fn.startswith("."):
-                    continue
+        dir_list = []
+        other_list = []
+        try:
+            with os.scandir(dir_fn) as it:
+                for entry in it:
+                    if not show_hidden and entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        dir_list.append(entry)
+                    else:
+                        other_list.append(entry)
+        except OSError as E:
+            print("{}|_ \x1b[31m{}\x1b[0m".format(tab * level, E))
+            return
 
-                fn = os.path.join(dir_fn, fn)
-                if os.path.isdir(fn):
-                    dir_list.append(fn)
-                else:
-                    other_list.append(fn)
-
-            if not dir_only:
-                if other_list:
-                    for fn in sorted(other_list):
-                        if os.path.isfile(fn):
-                            color = "32"
-                        elif os.path.islink(fn):
-                            color = "31"
-                        else:
-                            color = "37"
-                        print(
-                            "{}|_ \x1b[{}m{} [{}]\x1b[0m".format(
-                                tab * level,
-                                color,
-                                os.path.basename(fn),
-                                get_size_str(fn),
-                            )
-                        )
-
-            if dir_list:
-                for fn in sorted(dir_list):
-                    print(
-                        "{}|_ \x1b[{}m{}\x1b[0m".format(
-                            tab * level, 34, os.path.basename(fn)
-                        )
-                    )
-                    if not depth == 1:
-                        tree(
-                            dir_fn=fn,
-                            depth=depth - 1,
-                            dir_only=dir_only,
-                            tab=tab,
-                            level=level + 1,
-                        )
+        if not dir_only:
+            for entry in sorted(other_list, key=lambda e: e.name):
+                color, size_str = _entry_info(entry)
+                print("{}|_ \x1b[{}m{} [{}]\x1b[0m".format(tab * level, color, entry.name, size_str))
 
-def ls(dir_fn="./"):
+        for entry in sorted(dir_list, key=lambda e: e.name):
+            if du:
+                _, size_str = _entry_info(entry, du=True, threads=threads)
+                print("{}|_ \x1b[{}m{} [{}]\x1b[0m".format(tab * level, 34, entry.name, size_str))
+            else:
+                print("{}|_ \x1b[{}m{}\x1b[0m".format(tab * level, 34, entry.name))
+            if not depth == 1:
+                tree(
+                    dir_fn=entry.path,
+                    depth=depth - 1,
+                    dir_only=dir_only,
+                    tab=tab,
+                    show_hidden=show_hidden,
+                    level=level + 1,
+                    du=du,
+                    threads=threads,
+                )
+
+def ls(dir_fn="./", du=False, threads=4):
     """
     Simple function to emulate ls -lahG
+    * du
+        If True print the recursive size of directories (see dir_size)
+    * threads
+        Number of threads used to compute directory sizes
     """
     dir_fn = dir_fn.rstrip("/")
 
@@ -767,22 +1822,12 @@ def ls(dir_fn="./"):
         print(f"{dir_fn} is not a directory")
     else:
         print(dir_fn)
-        fn_list = os.listdir(dir_fn)
-        fn_list.sort()
-
-        for fn in sorted(fn_list):
-            path = os.path.join(dir_fn, fn)
-
-            if os.path.isdir(path):
-                color = "34"
-            elif os.path.isfile(path):
-                color = "32"
-            elif os.path.islink(path):
-                color = "31"
-            else:
-                color = "37"
+        with os.scandir(dir_fn) as it:
+            entry_list = sorted(it, key=lambda e: e.name)
 
-            print(" \x1b[{}m{:<12} {}\x1b[0m".format(color, get_size_str(path), fn))
+        for entry in entry_list:
+            color, size_str = _entry_info(entry, du=du, threads=threads)
+            print(" \x1b[{}m{:<12} {}\x1b[0m".format(color, size_str, entry.name))
 
 # ~~~~~~~ SHELL MANIPULATION ~~~~~~~#
 
@@ -799,114 +1844,413 @@ def bash(
     log_stderr=None,
     print_cmd=False,
     dry=False,
+    stdout_callback=None,
+    stderr_callback=None,
+    spool_size=None,
     **kwargs,
 ):
     """
     More advanced version of bash calling with live printing of the standard output and possibilities to log the
     redirect the output and error as a string return or directly in files. If ret_stderr and ret_stdout are True a
     tuple will be returned and if both are False None will be returned
+    Both standard streams are drained concurrently, so a command writing a lot on one of them cannot block.
     * cmd
         A command line string formatted as a string
     * virtualenv
         If specified will try to load a virtualenvwrapper environment before runing the command
     * conda
         If specified will try to load a conda environment before runing the command
+    * live
+        Deprecated. Both stdout and stderr are now printed live
     * print_stdout
         If True the standard output will be LIVE printed through the system standard output stream
     * ret_stdout
         If True the standard output will be returned as a string
     * log_stdout
-        If a filename is given, the standard output will logged in this file
+        If a filename is given, the standard output will logged in this file, as it is produced
     * print_stderr
         If True the standard error will be printed through the system standard error stream
     * ret_stderr
         If True the standard error will be returned as a string
     * log_stderr
-        If a filename is given, the standard error will logged in this file
+        If a filename is given, the standard error will logged in this file, as it is produced
+    * stdout_callback
+        Function called with each line of the standard output
+    * stderr_callback
+        Function called with each line of the standard error
+    * spool_size
+        If given, returned outputs are captured in temporary files kept in memory up to spool_size bytes and spilled
+        to disk above. They are then returned as text file handles, positioned at the start, that can be read or
+        iterated line by line lazily, instead of strings. The handles should be closed after use
     """
     if print_cmd:
         print(cmd)
     if dry:
         return
 
-    if virtualenv:
-        cmd = "source ~/.bashrc && workon {} && {} && deactivate".format(
-            virtualenv, cmd
-        )
-    elif conda:
-        cmd = "source ~/.bashrc && conda activate {} && {} && conda deactivate".format(
-            conda, cmd
-        )
-
-    # empty str buffer
-    stdout_str = ""
-    stderr_str = ""
+    cmd = _wrap_env_cmd(cmd, virtualenv=virtualenv, conda=conda)
+    stdout_sink, stderr_sink = _bash_sinks(
+        print_stdout, ret_stdout, log_stdout, stdout_callback,
+        print_stderr, ret_stderr, log_stderr, stderr_callback,
+        spool_size,
+    )
 
     # First execute the command parse the output
-    with Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, executable="bash") as proc:
-
-        # Only 1 standard stream can be output at the time stdout or stderr
-        while proc.poll() is None:
-
-            # Live parse stdout
-            if live == "stdout":
-                for line in iter(proc.stdout.readline, b""):
-                    if print_stdout:
-                        sys.stdout.write(line.decode())
-                    if ret_stdout or log_stdout:
-                        stdout_str += line.decode()
-
-            # Live parse stderr
-            elif live == "stderr":
-                for line in iter(proc.stderr.readline, b""):
-                    if print_stderr:
-                        sys.stderr.write(line.decode())
-                    if ret_stderr or log_stderr:
-                        stderr_str += line.decode()
-
-        # Verify that the command was successful and if not print error message and raise an exception
-        if proc.returncode >= 1:
-            sys.stderr.write(
-                "Error code #{} during execution of the command : {}\n".format(
-                    proc.returncode, cmd
-                )
+    try:
+        with Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, executable="bash") as proc:
+            reader_list = [
+                threading.Thread(target=stdout_sink.drain, args=(proc.stdout,), daemon=True),
+                threading.Thread(target=stderr_sink.drain, args=(proc.stderr,), daemon=True),
+            ]
+            for reader in reader_list:
+                reader.start()
+            for reader in reader_list:
+                reader.join()
+            proc.wait()
+    finally:
+        stdout_sink.close_log()
+        stderr_sink.close_log()
+
+    return _bash_result(cmd, proc.returncode, stdout_sink, stderr_sink, ret_stdout, ret_stderr)
+
+async def bash_async(
+    cmd,
+    virtualenv=None,
+    conda=None,
+    print_stdout=True,
+    ret_stdout=False,
+    log_stdout=None,
+    print_stderr=True,
+    ret_stderr=False,
+    log_stderr=None,
+    print_cmd=False,
+    dry=False,
+    stdout_callback=None,
+    stderr_callback=None,
+    spool_size=None,
+):
+    """
+    Coroutine counterpart of bash, with the same options and return values, running the command with
+    asyncio.create_subprocess_shell. It does not block the event loop, so that many commands can be run
+    concurrently from a single thread or from a jupyter notebook, with `await bash_async(...)` or
+    `await asyncio.gather(*[bash_async(cmd) for cmd in cmd_list])`.
+    * cmd
+        A command line string formatted as a string
+    * virtualenv
+        If specified will try to load a virtualenvwrapper environment before runing the command
+    * conda
+        If specified will try to load a conda environment before runing the command
+    * print_stdout
+        If True the standard output will be LIVE printed through the system standard output stream
+    * ret_stdout
+        If True the standard output will be returned as a string
+    * log_stdout
+        If a filename is given, the standard output will logged in this file, as it is produced
+    * print_stderr
+        If True the standard error will be printed through the system standard error stream
+    * ret_stderr
+        If True the standard error will be returned as a string
+    * log_stderr
+        If a filename is given, the standard error will logged in this file, as it is produced
+    * stdout_callback
+        Function called with each line of the standard output
+    * stderr_callback
+        Function called with each line of the standard error
+    * spool_size
+        If given, returned outputs are spooled in temporary files and returned as text file handles (see bash)
+    """
+    if print_cmd:
+        print(cmd)
+    if dry:
+        return
+
+    cmd = _wrap_env_cmd(cmd, virtualenv=virtualenv, conda=conda)
+    stdout_sink, stderr_sink = _bash_sinks(
+        print_stdout, ret_stdout, log_stdout, stdout_callback,
+        print_stderr, ret_stderr, log_stderr, stderr_callback,
+        spool_size,
+    )
+
+    try:
+        proc = await asyncio.create_subprocess_shell(
+            cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            executable="bash",
+            limit=BUF_SIZE,
+        )
+        try:
+            await asyncio.gather(
+                stdout_sink.drain_async(proc.stdout),
+                stderr_sink.drain_async(proc.stderr),
             )
-            for line in iter(proc.stderr.readline, b""):
-                sys.stderr.write(line.decode())
-            return None
+            await proc.wait()
+        except asyncio.CancelledError:
+            # Do not leave the command running if the coroutine is cancelled
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+    finally:
+        stdout_sink.close_log()
+        stderr_sink.close_log()
+
+    return _bash_result(cmd, proc.returncode, stdout_sink, stderr_sink, ret_stdout, ret_stderr)
+
+def _bash_sinks(
+    print_stdout, ret_stdout, log_stdout, stdout_callback,
+    print_stderr, ret_stderr, log_stderr, stderr_callback,
+    spool_size=None,
+):
+    """
+    Create the stdout and stderr _StreamSink of bash and bash_async
+    """
+    stdout_sink = _StreamSink(
+        out=sys.stdout if print_stdout else None,
+        capture=ret_stdout,
+        callback=stdout_callback,
+        log_fn=log_stdout,
+        spool_size=spool_size,
+    )
+    # The end of stderr is always kept if not printed to be reported in case of error
+    stderr_sink = _StreamSink(
+        out=sys.stderr if print_stderr else None,
+        capture=ret_stderr,
+        callback=stderr_callback,
+        log_fn=log_stderr,
+        spool_size=spool_size,
+        tail=0 if print_stderr else 1000,
+    )
+    return stdout_sink, stderr_sink
 
-        if live != "stdout" and (print_stdout or ret_stdout or log_stdout):
-            for line in iter(proc.stdout.readline, b""):
-                if print_stdout:
-                    sys.stdout.write(line.decode())
-                if ret_stdout or log_stdout:
-                    stdout_str += line.decode()
-
-        if live != "stderr" and (print_stderr or ret_stderr or log_stderr):
-            for line in iter(proc.stderr.readline, b""):
-                if print_stderr:
-                    sys.stderr.write(line.decode())
-                if ret_stderr or log_stderr:
-                    stderr_str += line.decode()
-
-        # Write log in file if requested
-        if log_stdout:
-            with open(log_stdout, "w") as fp:
-                fp.write(stdout_str)
-
-        if log_stderr:
-            with open(log_stderr, "w") as fp:
-                fp.write(stderr_str)
+def _bash_result(cmd, returncode, stdout_sink, stderr_sink, ret_stdout=False, ret_stderr=False):
+    """
+    Report errors and build the return value of bash and bash_async
+    """
+    # Verify that the command was successful and if not print error message and raise an exception
+    if returncode >= 1:
+        sys.stderr.write(
+            "Error code #{} during execution of the command : {}\n".format(
+                returncode, cmd
+            )
+        )
+        sys.stderr.write("".join(stderr_sink.tail))
+        stdout_sink.discard()
+        stderr_sink.discard()
+        return None
 
     # Return standard output and err if requested
     if ret_stdout and ret_stderr:
-        return (stdout_str, stderr_str)
+        return (stdout_sink.getvalue(), stderr_sink.getvalue())
     if ret_stdout:
-        return stdout_str
+        return stdout_sink.getvalue()
     if ret_stderr:
-        return stderr_str
+        return stderr_sink.getvalue()
     return None
 
+def bash_batch(
+    cmd_list,
+    workers=4,
+    virtualenv=None,
+    conda=None,
+    ret_stdout=True,
+    ret_stderr=True,
+    fail_fast=False,
+    progress=True,
+):
+    """
+    Run a list of independent command lines concurrently with at most `workers` commands running at a time.
+    Return a Dataframe with the return code, the runtime in seconds and the captured output of each command, in
+    the order of submission. Commands cancelled in fail_fast mode have no return code
+    * cmd_list
+        List of command lines formatted as strings
+    * workers
+        Maximal number of commands running at the same time
+    * virtualenv
+        If specified will try to load a virtualenvwrapper environment before runing each command
+    * conda
+        If specified will try to load a conda environment before runing each command
+    * ret_stdout
+        If True the standard output of each command is captured
+    * ret_stderr
+        If True the standard error of each command is captured
+    * fail_fast
+        If True, the first failing command cancels the pending commands and terminates the running ones
+    * progress
+        Display a progress bar of completed commands
+    """
+    proc_set = set()
+    stop_event = threading.Event()
+    result_list = [
+        OrderedDict(cmd=cmd, returncode=None, runtime=None, stdout=None, stderr=None) for cmd in cmd_list
+    ]
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor, tqdm(
+        total=len(cmd_list), desc="Commands completed ", unit=" cmds", disable=not progress
+    ) as pb:
+        future_dict = {}
+        for i, cmd in enumerate(cmd_list):
+            future = executor.submit(
+                _run_batch_cmd,
+                cmd=_wrap_env_cmd(cmd, virtualenv=virtualenv, conda=conda),
+                result=result_list[i],
+                ret_stdout=ret_stdout,
+                ret_stderr=ret_stderr,
+                proc_set=proc_set,
+                stop_event=stop_event,
+            )
+            future_dict[future] = i
+
+        for future in as_completed(future_dict):
+            pb.update()
+            if future.cancelled():
+                continue
+            result = future.result()
+            if fail_fast and result["returncode"] and not stop_event.is_set():
+                cprint(
+                    "Command #{} failed with error code #{}, cancelling remaining commands".format(
+                        future_dict[future], result["returncode"]
+                    ),
+                    color="red",
+                )
+                stop_event.set()
+                for f in future_dict:
+                    f.cancel()
+                for proc in list(proc_set):
+                    _kill_process_group(proc)
+
+    return pd.DataFrame(result_list)
+
+def _run_batch_cmd(cmd, result, ret_stdout=True, ret_stderr=True, proc_set=None, stop_event=None):
+    """
+    Worker function of bash_batch running a single command and filling its result dict
+    """
+    if proc_set is None:
+        proc_set = set()
+    if stop_event and stop_event.is_set():
+        return result
+    stdout_sink = _StreamSink(capture=ret_stdout)
+    stderr_sink = _StreamSink(capture=ret_stderr)
+
+    t = time.time()
+    # Each command runs in its own process group, so that all its children can be terminated together
+    with Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, executable="bash", start_new_session=True) as proc:
+        proc_set.add(proc)
+        # Catch commands started while a failure was being handled
+        if stop_event and stop_event.is_set():
+            _kill_process_group(proc)
+        reader = threading.Thread(target=stderr_sink.drain, args=(proc.stderr,), daemon=True)
+        reader.start()
+        stdout_sink.drain(proc.stdout)
+        reader.join()
+        proc.wait()
+        proc_set.discard(proc)
+
+    result["returncode"] = proc.returncode
+    result["runtime"] = round(time.time() - t, 3)
+    if ret_stdout:
+        result["stdout"] = stdout_sink.getvalue()
+    if ret_stderr:
+        result["stderr"] = stderr_sink.getvalue()
+    return result
+
+def _kill_process_group(proc, sig=signal.SIGTERM):
+    """
+    Send a signal to the process group of a command started in a new session
+    """
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+def _wrap_env_cmd(cmd, virtualenv=None, conda=None):
+    """
+    Wrap a command to run it in a virtualenvwrapper or conda environment
+    """
+    if virtualenv:
+        cmd = "source ~/.bashrc && workon {} && {} && deactivate".format(
+            virtualenv, cmd
+        )
+    elif conda:
+        cmd = "source ~/.bashrc && conda activate {} && {} && conda deactivate".format(
+            conda, cmd
+        )
+    return cmd
+
+class _StreamSink:
+    """
+    Destination of the lines of a standard stream of a subprocess: live printing, callback, log file written as
+    lines arrive, capture in a list of chunks or in a temporary file spilled to disk above spool_size bytes,
+    and optionally the last lines in a bounded deque
+    """
+    def __init__(self, out=None, capture=False, callback=None, log_fn=None, spool_size=None, tail=0):
+        self.out = out
+        self.capture = capture
+        self.callback = callback
+        self.chunk_list = []
+        self.spool = None
+        if capture and spool_size is not None:
+            self.spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.log_fp = open(log_fn, "wb") if log_fn else None
+        self.tail = deque(maxlen=tail)
+
+    def drain(self, stream):
+        """
+        Read all the lines of a binary stream until EOF
+        """
+        for line in iter(stream.readline, b""):
+            self.write(line)
+
+    async def drain_async(self, stream):
+        """
+        Read all the lines of an asyncio StreamReader until EOF
+        """
+        while True:
+            try:
+                line = await stream.readuntil(b"\n")
+            except asyncio.IncompleteReadError as E:
+                # Last line without newline
+                line = E.partial
+            except asyncio.LimitOverrunError as E:
+                # Line longer than the stream limit, pass it in pieces
+                line = await stream.read(E.consumed)
+            if not line:
+                break
+            self.write(line)
+
+    def write(self, raw_line):
+        if self.log_fp:
+            self.log_fp.write(raw_line)
+        if self.spool:
+            self.spool.write(raw_line)
+        if self.out or self.callback or self.tail.maxlen or (self.capture and not self.spool):
+            line = raw_line.decode(errors="replace")
+            if self.out:
+                self.out.write(line)
+            if self.callback:
+                self.callback(line)
+            if self.tail.maxlen:
+                self.tail.append(line)
+            if self.capture and not self.spool:
+                self.chunk_list.append(line)
+
+    def close_log(self):
+        if self.log_fp:
+            self.log_fp.close()
+
+    def discard(self):
+        if self.spool:
+            self.spool.close()
+
+    def getvalue(self):
+        """
+        Return the captured lines as a string, or as a text handle over the spool file
+        """
+        if self.spool:
+            self.spool.seek(0)
+            return io.TextIOWrapper(self.spool, encoding="utf-8", errors="replace")
+        return "".join(self.chunk_list)
+
 def qsub(
     cmd_list,
     mem="1G",
@@ -931,31 +2275,10 @@ def qsub(
         os.remove(stderr_fn)
 
     with open(script_fn, "w") as fp:
-        fp.write(f"#! {shell}\n")
-        fp.write(f"#$ -S {shell}\n")
-        fp.write("#$ -cwd\n")
-
-        if job_name:
-            fp.write(f"#$ -N {job_name}\n")
-        if project:
-            fp.write(f"#$ -P {project}\n")
-        if threads:
-            fp.write(f"#$ -pe mt {threads}\n")
-        if gpu:
-            fp.write(f"#$ -l gpu=1\n")
-        if node:
-            fp.write(f"#$ -l h={node}\n")
-        if mem:
-            fp.write(f"#$ -l m_mem_free={mem}\n")
-        if queue:
-            if queue == "algo":
-                fp.write(f"#$ -l algo=1\n")
-            else:
-                fp.write(f"#$ -q {queue}\n")
-        if stdout_fn:
-            fp.write(f"#$ -o {stdout_fn}\n")
-        if stderr_fn:
-            fp.write(f"#$ -e {stderr_fn}\n")
+        _write_qsub_header(
+            fp, mem=mem, threads=threads, gpu=gpu, queue=queue, project=project, node=node,
+            job_name=job_name, shell=shell, stdout_fn=stdout_fn, stderr_fn=stderr_fn,
+        )
         fp.write("\n")
 
         if type(cmd_list) == str:
@@ -965,21 +2288,135 @@ def qsub(
         for cmd in cmd_list:
             fp.write(f"{cmd}\n")
 
+    return _submit_qsub_script(script_fn, print_script=print_script, dry=dry)
+
+def qsub_array(
+    task_list,
+    mem="1G",
+    threads=1,
+    gpu=False,
+    queue="algo",
+    project="research",
+    node="bowhead001",
+    job_name=None,
+    max_running=None,
+    print_script=False,
+    dry=False,
+    shell="/bin/bash",
+    log_dir="qsub_logs",
+    script_fn=None,
+):
+    """
+    FOR JUPYTER NOTEBOOK IN SGE environment
+    Submit a list of tasks as a single SGE job array (-t 1-N) instead of one job per task. Each task is a command
+    line string or a list of command lines run sequentially. Return the job id of the array.
+    The standard output and error of each task are written in log_dir, in {JOB_ID}.{TASK_ID}.stdout.txt and
+    {JOB_ID}.{TASK_ID}.stderr.txt, so that logs of successive submissions do not clobber each other.
+    * task_list
+        List of tasks, each task being a command line string or a list of command lines
+    * mem, threads, gpu, queue, project, node, job_name, shell
+        Resources and options of each task, as for qsub
+    * max_running
+        Maximal number of tasks of the array running at the same time (-tc)
+    * log_dir
+        Directory where the task logs and the array script are written
+    * script_fn
+        Path of the array script. By default {log_dir}/{job_name}_array_script.sh
+    """
+    if not task_list:
+        raise ValueError("task_list is empty")
+    os.makedirs(log_dir, exist_ok=True)
+    if not script_fn:
+        script_fn = os.path.join(log_dir, "{}_array_script.sh".format(job_name if job_name else "qsub"))
+
+    with open(script_fn, "w") as fp:
+        _write_qsub_header(
+            fp, mem=mem, threads=threads, gpu=gpu, queue=queue, project=project, node=node, job_name=job_name,
+            shell=shell,
+            stdout_fn=os.path.join(log_dir, "$JOB_ID.$TASK_ID.stdout.txt"),
+            stderr_fn=os.path.join(log_dir, "$JOB_ID.$TASK_ID.stderr.txt"),
+        )
+        fp.write(f"#$ -t 1-{len(task_list)}\n")
+        if max_running:
+            fp.write(f"#$ -tc {max_running}\n")
+        fp.write("\n")
+
+        fp.write(f"source ~/.bashrc\n")
+        fp.write('case "$SGE_TASK_ID" in\n')
+        for task_id, cmd_list in enumerate(task_list, 1):
+            if type(cmd_list) == str:
+                cmd_list = [cmd_list]
+            fp.write(f"{task_id})\n")
+            for cmd in cmd_list:
+                fp.write(f"{cmd}\n")
+            fp.write(";;\n")
+        fp.write("esac\n")
+
+    job_id = _submit_qsub_script(script_fn, print_script=print_script, dry=dry)
+    # qsub reports job arrays as {JOB_ID}.{FIRST}-{LAST}:{STEP}
+    if isinstance(job_id, str):
+        job_id = job_id.split(".")[0]
+    return job_id
+
+def _write_qsub_header(
+    fp,
+    mem="1G",
+    threads=1,
+    gpu=False,
+    queue="algo",
+    project="research",
+    node="bowhead001",
+    job_name=None,
+    shell="/bin/bash",
+    stdout_fn=None,
+    stderr_fn=None,
+):
+    """
+    Write the shebang and SGE directives of a qsub script
+    """
+    fp.write(f"#! {shell}\n")
+    fp.write(f"#$ -S {shell}\n")
+    fp.write("#$ -cwd\n")
+
+    if job_name:
+        fp.write(f"#$ -N {job_name}\n")
+    if project:
+        fp.write(f"#$ -P {project}\n")
+    if threads:
+        fp.write(f"#$ -pe mt {threads}\n")
+    if gpu:
+        fp.write(f"#$ -l gpu=1\n")
+    if node:
+        fp.write(f"#$ -l h={node}\n")
+    if mem:
+        fp.write(f"#$ -l m_mem_free={mem}\n")
+    if queue:
+        if queue == "algo":
+            fp.write(f"#$ -l algo=1\n")
+        else:
+            fp.write(f"#$ -q {queue}\n")
+    if stdout_fn:
+        fp.write(f"#$ -o {stdout_fn}\n")
+    if stderr_fn:
+        fp.write(f"#$ -e {stderr_fn}\n")
+
+def _submit_qsub_script(script_fn, print_script=False, dry=False):
+    """
+    Submit a script with qsub and return the job id
+    """
     if print_script:
         with open(script_fn, "r") as fp:
             print(fp.read())
 
     if dry:
         return random.randint(0, 100000)
-    else:
-        stdout = bash(cmd=f"qsub {script_fn}", ret_stdout=True, print_stdout=False)
-        try:
-            if stdout:
-                return stdout.split(" ")[2]
 
-        except Exception as E:
-            cprint("ERROR: job not submitted", color="red")
-            cprint(str(E))
+    scheduler = get_scheduler()
+    jobid = scheduler.submit(script_fn)
+    # The cached qstat snapshot does not contain the new job
+    if jobid:
+        _QSTAT_CACHE.pop(scheduler, None)
+    return jobid
 
 def qstat(
     jobid=None,
@@ -987,66 +2424,424 @@ def qstat(
     state=None,
     queue=None,
     name=None,
+    ttl=None,
+    xml_fn=None,
 ):
     """
     FOR JUPYTER NOTEBOOK IN SGE environment
-    Emulate SGE qstat command. Return a Dataframe of jobs
+    Emulate SGE qstat command. Return a Dataframe of jobs of the current scheduler (see set_scheduler)
+    With the SGE scheduler, the xml output of `qstat -xml -r` is parsed into typed columns and the snapshot is reused for ttl seconds.
+    The filters are regular expressions matched at the start of the corresponding column
+    * jobid, user, state, queue, name
+        Filter the jobs on job-ID, user, state, queue and name
+    * ttl
+        Reuse the last qstat snapshot if it is more recent than ttl seconds. 0 to always call qstat.
+        Default to QSTAT_CACHE_TTL. The snapshot is discarded when a job is submitted with qsub or qsub_array
+    * xml_fn
+        Parse a saved `qstat -xml` output file instead of calling qstat
+    """
+    df = _qstat_snapshot(ttl=ttl, xml_fn=xml_fn)
+    if df is None:
+        return None
+
+    # filter if needed
+    mask = np.ones(len(df), dtype=bool)
+    for field, regex in (("job-ID", jobid), ("user", user), ("state", state), ("queue", queue), ("name", name)):
+        if regex:
+            mask &= df[field].astype(str).str.match(str(regex)).values
+    return df[mask].reset_index(drop=True)
+
+def _qstat_snapshot(ttl=None, xml_fn=None):
+    """
+    Return the Dataframe of all jobs of the current scheduler or from a saved xml file, using the cache if fresh
+    enough
+    """
+    if xml_fn:
+        return _parse_qstat_xml(xml_fn)
+
+    if ttl is None:
+        ttl = QSTAT_CACHE_TTL
+    scheduler = get_scheduler()
+    now = time.time()
+    cached = _QSTAT_CACHE.get(scheduler)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+
+    df = scheduler.snapshot()
+    if df is not None:
+        _QSTAT_CACHE[scheduler] = (now, df)
+    return df
+
+def _parse_qstat_xml(source):
     """
+    Incrementally parse a qstat -xml output from a file path or file object into a Dataframe with typed columns
+    """
+    job_list = []
+    job = {}
+    for _, elem in ET.iterparse(source, events=("end",)):
+        if elem.tag == "job_list":
+            job["status"] = elem.get("state")
+            job_list.append(job)
+            job = {}
+            elem.clear()
+        elif elem.tag in QSTAT_XML_TAGS:
+            job[QSTAT_XML_TAGS[elem.tag]] = elem.text
+
+    columns = list(OrderedDict.fromkeys(QSTAT_XML_TAGS.values())) + ["status"]
+    df = pd.DataFrame(job_list, columns=columns)
+    df["job-ID"] = df["job-ID"].astype(np.int64)
+    df["prior"] = df["prior"].astype(float)
+    df["slots"] = df["slots"].fillna(0).astype(np.int64)
+    # Some Grid Engine builds (eg Univa) write fractional seconds. Unparsable times are set to NaT
+    time_str = df["submit/start_at"]
+    time_str = time_str.where(time_str.isna() | time_str.str.contains(".", regex=False), time_str + ".0")
+    df["submit/start_at"] = pd.to_datetime(time_str, format="%Y-%m-%dT%H:%M:%S.%f", errors="coerce")
+    for field in ("name", "user", "state", "queue", "ja-task-ID", "status"):
+        df[field] = df[field].fillna("").astype(str)
+    return df
+
+class qsub_monitor ():
+    def __init__(self, job_ids=[], callback=None, min_interval=5, max_interval=300, backoff=2, verbose=False):
+        """
+        FOR JUPYTER NOTEBOOK IN SGE environment
+        Track a set of jobs with a single `qstat -xml` call per poll for all of them. The polling interval starts at
+        min_interval and is multiplied by backoff after each poll without any state change, up to max_interval.
+        Jobs that disappear from qstat are considered completed. Array jobs are followed as a whole.
+        * job_ids: list (default [])
+            Job ids to track, as returned by qsub or qsub_array. More can be added with add
+        * callback: function or None (default None)
+            Function called with (job_id, job_info_dict) when a job completes
+        * min_interval: float (default 5)
+            Minimal interval between polls in seconds
+        * max_interval: float (default 300)
+            Maximal interval between polls in seconds
+        * backoff: float (default 2)
+            Multiplicative factor of the interval when nothing changes between polls
+        * verbose: bool (default False)
+        """
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.verbose = verbose
+        self.interval = min_interval
+        self.n_polls = 0
+        self.jobs = OrderedDict()
+        self.callbacks = {}
+        for job_id in job_ids:
+            self.add(job_id)
+
+    def add(self, job_id, callback=None):
+        """
+        Start tracking a job, with an optional job specific completion callback
+        """
+        job_id = str(job_id)
+        if job_id not in self.jobs:
+            self.jobs[job_id] = OrderedDict(
+                state="submitted", tasks=0, added=time.time(), started=None, completed=None, runtime=None
+            )
+        if callback:
+            self.callbacks[job_id] = callback
+        self.interval = self.min_interval
 
-    stdout = bash(
-        "qstat -r",
-        print_stderr=False,
-        print_stdout=False,
-        ret_stderr=False,
-        ret_stdout=True,
-    )
+    @property
+    def pending(self):
+        """
+        List of tracked jobs not completed yet
+        """
+        return [job_id for job_id, job in self.jobs.items() if job["state"] != "completed"]
+
+    @property
+    def summary(self):
+        """
+        Dataframe of the tracked jobs with their last known state and timings
+        """
+        df = pd.DataFrame.from_dict(self.jobs, orient="index")
+        df.index.name = "job_id"
+        for col in ("added", "started", "completed"):
+            df[col] = pd.to_datetime(df[col].astype(float), unit="s")
+        return df
+
+    def poll(self):
+        """
+        Query the scheduler once, update the state of all tracked jobs and run the callbacks of completed jobs.
+        Return the number of jobs whose state changed, or None if qstat failed
+        """
+        state_dict = _qstat_states()
+        self.n_polls += 1
+        if state_dict is None:
+            return None
 
-    if stdout:
-        jobs = []
-        header = []
-        for l in stdout.split("\n"):
-            if l:
-                if not header:
-                    l = l.replace("submit/start at", "submit/start_at")
-                    field = ""
-                    prev = " "
-                    start = 0
-                    for i, c in enumerate(l):
-                        if c != " " and prev == " ":
-                            if field:
-                                header.append((field.strip(), start, i))
-                            start = i
-                            field = c
-                        else:
-                            field += c
-                        prev = c
-
-                elif l.strip().split()[0].isdigit():
-                    job_dict = OrderedDict()
-                    for field, start, end in header:
-                        value = l[start:end].strip()
-                        job_dict[field] = value
-
-                elif l.strip().split(":")[0] == "Full jobname":
-                    job_dict["name"] = l.split(":")[1].strip()
-                    jobs.append(job_dict)
-
-        df = pd.DataFrame(jobs)
-
-        # filter if needed
-        if jobid:
-            df = df[df["job-ID"].str.match(jobid)]
-        if user:
-            df = df[df["user"].str.match(user)]
-        if state:
-            df = df[df["state"].str.match(state)]
-        if queue:
-            df = df[df["queue"].str.match(queue)]
-        if name:
-            df = df[df["name"].str.match(name)]
+        now = time.time()
+        n_changed = 0
+        for job_id in self.pending:
+            job = self.jobs[job_id]
+            if job_id in state_dict:
+                task_states = state_dict[job_id]
+                state = _merge_job_states(task_states)
+                if state != job["state"] or len(task_states) != job["tasks"]:
+                    n_changed += 1
+                job["state"] = state
+                job["tasks"] = len(task_states)
+                if job["started"] is None and "r" in state:
+                    job["started"] = now
+            else:
+                n_changed += 1
+                job["state"] = "completed"
+                job["tasks"] = 0
+                job["completed"] = now
+                job["runtime"] = now - (job["started"] or job["added"])
+                if self.verbose:
+                    cprint(f"Job {job_id} completed", color="green")
+                for callback in (self.callbacks.get(job_id), self.callback):
+                    if callback:
+                        callback(job_id, job)
+
+        # Exponential backoff while nothing changes
+        if n_changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return n_changed
 
+    def wait(self, timeout=None):
+        """
+        Poll until all the tracked jobs are completed or until timeout seconds. Return the summary Dataframe
+        """
+        start = time.time()
+        while True:
+            self.poll()
+            pending = len(self.pending)
+            if self.verbose:
+                cprint(f"Poll #{self.n_polls}: {pending} job(s) pending, next poll in {self.interval}s", color="grey")
+            if not pending:
+                break
+            if timeout is not None and time.time() - start + self.interval > timeout:
+                cprint(f"Timeout: {pending} job(s) still pending", color="red")
+                break
+            time.sleep(self.interval)
+        return self.summary
+
+def _qstat_states():
+    """
+    Return a dict of job id to the list of states of its tasks from a single qstat call, or None if qstat failed
+    """
+    df = _qstat_snapshot(ttl=0)
+    if df is None:
+        return None
+    state_dict = defaultdict(list)
+    for job_id, state in zip(df["job-ID"], df["state"]):
+        state_dict[str(job_id)].append(state)
+    return state_dict
+
+def _merge_job_states(task_states):
+    """
+    Summarise the states of the tasks of a job as a comma separated string of unique states
+    """
+    return ",".join(sorted(set(task_states)))
+
+def set_scheduler(scheduler="sge", **kwargs):
+    """
+    Select the scheduler backend used by qsub, qsub_array, qstat and qsub_monitor. Return the backend
+    * scheduler
+        "sge", "local" or a scheduler object implementing submit(script_fn) and snapshot()
+    * kwargs
+        Options passed to the backend constructor, for example workers for the local scheduler
+    """
+    global _SCHEDULER
+    if scheduler == "sge":
+        scheduler = sge_scheduler(**kwargs)
+    elif scheduler == "local":
+        scheduler = local_scheduler(**kwargs)
+    _SCHEDULER = scheduler
+    return scheduler
+
+def get_scheduler():
+    """
+    Return the current scheduler backend. SGE by default
+    """
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        _SCHEDULER = sge_scheduler()
+    return _SCHEDULER
+
+class sge_scheduler ():
+    """
+    Scheduler backend submitting scripts with SGE qsub and listing jobs with qstat -xml
+    """
+    def submit(self, script_fn):
+        """
+        Submit a script and return the job id
+        """
+        stdout = bash(cmd=f"qsub {script_fn}", ret_stdout=True, print_stdout=False)
+        try:
+            if stdout:
+                return stdout.split(" ")[2]
+
+        except Exception as E:
+            cprint("ERROR: job not submitted", color="red")
+            cprint(str(E))
+
+    def snapshot(self):
+        """
+        Return a Dataframe of the current jobs, or None if qstat failed
+        """
+        fh = bash(
+            "qstat -xml -r",
+            print_stderr=False,
+            print_stdout=False,
+            ret_stdout=True,
+            spool_size=16 * BUF_SIZE,
+        )
+        if fh is None:
+            return None
+        with fh:
+            return _parse_qstat_xml(fh)
+
+class local_scheduler ():
+    def __init__(self, workers=4):
+        """
+        Scheduler backend running qsub scripts on the local machine, at most `workers` tasks at a time.
+        The SGE directives of the scripts that make sense locally are honoured: -N, -o, -e (with $JOB_ID,
+        $TASK_ID and $JOB_NAME), -t and -tc. Resource requests are ignored. Tasks run with bash in the
+        submission directory with the JOB_ID, JOB_NAME and SGE_TASK_ID variables set, and are listed by
+        snapshot as pending (qw) or running (r) until they finish, as with qstat.
+        The return code of finished tasks is kept in the exit_status dict, indexed by (job_id, task_id)
+        * workers: int (default 4)
+            Maximal number of tasks running at the same time
+        """
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.last_job_id = 0
+        self.pending = deque()
+        self.running = {}
+        self.exit_status = {}
+
+    def submit(self, script_fn):
+        """
+        Queue the tasks of a script and return the job id
+        """
+        directive_dict = _read_qsub_directives(script_fn)
+        with self.lock:
+            self.last_job_id += 1
+            job_id = str(self.last_job_id)
+        name = directive_dict.get("N", os.path.basename(script_fn))
+        # Spool the script content at submission, as SGE does, since qsub reuses the same script file
+        with open(script_fn, "rb") as fp:
+            script = fp.read()
+
+        if "t" in directive_dict:
+            first, last = directive_dict["t"].split(":")[0].split("-")
+            task_list = list(range(int(first), int(last) + 1))
+            max_running = int(directive_dict.get("tc", 0)) or None
+        else:
+            task_list = [None]
+            max_running = None
+
+        submit_time = pd.Timestamp.now().floor("s")
+        with self.lock:
+            for task_id in task_list:
+                self.pending.append(OrderedDict(
+                    job_id=job_id,
+                    task_id=task_id,
+                    name=name,
+                    script=script,
+                    cwd=os.getcwd(),
+                    stdout_fn=directive_dict.get("o", f"{name}.o$JOB_ID"),
+                    stderr_fn=directive_dict.get("e", f"{name}.e$JOB_ID"),
+                    max_running=max_running,
+                    time=submit_time,
+                ))
+            self._dispatch()
+        return job_id
+
+    def snapshot(self):
+        """
+        Return a Dataframe of the pending and running tasks with the qstat columns
+        """
+        with self.lock:
+            task_list = [(task, "r") for task in self.running.values()] + [(task, "qw") for task in self.pending]
+        user = os.environ.get("USER", "")
+        job_list = []
+        for task, state in task_list:
+            job_list.append({
+                "job-ID": int(task["job_id"]),
+                "prior": 0.0,
+                "name": task["name"],
+                "user": user,
+                "state": state,
+                "submit/start_at": task["time"],
+                "queue": "local" if state == "r" else "",
+                "slots": 1,
+                "ja-task-ID": "" if task["task_id"] is None else str(task["task_id"]),
+                "status": "running" if state == "r" else "pending",
+            })
+        columns = list(OrderedDict.fromkeys(QSTAT_XML_TAGS.values())) + ["status"]
+        df = pd.DataFrame(job_list, columns=columns)
+        df["job-ID"] = df["job-ID"].astype(np.int64)
+        df["submit/start_at"] = pd.to_datetime(df["submit/start_at"])
         return df
 
+    def _dispatch(self):
+        """
+        Start pending tasks while worker slots are free. Must be called with the lock held
+        """
+        running_count = Counter(task["job_id"] for task in self.running.values())
+        skipped = deque()
+        while self.pending and len(self.running) < self.workers:
+            task = self.pending.popleft()
+            if task["max_running"] and running_count[task["job_id"]] >= task["max_running"]:
+                skipped.append(task)
+                continue
+            running_count[task["job_id"]] += 1
+            task["time"] = pd.Timestamp.now().floor("s")
+            self.running[(task["job_id"], task["task_id"])] = task
+            threading.Thread(target=self._run_task, args=(task,), daemon=True).start()
+        skipped.extend(self.pending)
+        self.pending = skipped
+
+    def _run_task(self, task):
+        """
+        Run a task script and release its worker slot
+        """
+        task_id = "undefined" if task["task_id"] is None else str(task["task_id"])
+        env = dict(os.environ, JOB_ID=task["job_id"], JOB_NAME=task["name"], SGE_TASK_ID=task_id)
+        log_fn_list = []
+        for fn in (task["stdout_fn"], task["stderr_fn"]):
+            fn = fn.replace("$JOB_ID", task["job_id"]).replace("$TASK_ID", task_id).replace("$JOB_NAME", task["name"])
+            log_fn_list.append(os.path.join(task["cwd"], fn))
+
+        returncode = None
+        script_fn = None
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".sh", delete=False) as script_fp:
+                script_fp.write(task["script"])
+                script_fn = script_fp.name
+            with open(log_fn_list[0], "ab") as stdout_fp, open(log_fn_list[1], "ab") as stderr_fp:
+                returncode = subprocess.call(
+                    ["bash", script_fn], cwd=task["cwd"], env=env, stdout=stdout_fp, stderr=stderr_fp
+                )
+        finally:
+            if script_fn:
+                os.remove(script_fn)
+            with self.lock:
+                self.exit_status[(task["job_id"], task["task_id"])] = returncode
+                del self.running[(task["job_id"], task["task_id"])]
+                self._dispatch()
+
+def _read_qsub_directives(script_fn):
+    """
+    Return a dict of the #$ directives of a qsub script. Repeated directives keep the last value
+    """
+    directive_dict = OrderedDict()
+    with open(script_fn) as fp:
+        for l in fp:
+            if l.startswith("#$"):
+                field_list = l[2:].strip().split(None, 1)
+                if field_list and field_list[0].startswith("-"):
+                    directive_dict[field_list[0][1:]] = field_list[1].strip() if len(field_list) > 1 else ""
+    return directive_dict
+
 ##~~~~~~~ DICTIONNARY FORMATTING ~~~~~~~#
 
 def dict_to_report(
@@ -1102,9 +2897,10 @@ def dict_to_report(
 
 ##~~~~~~~ WEB TOOLS ~~~~~~~#
 
-def wget(url, out_name=None, out_dir=None, ftp_proxy=None, http_proxy=None):
+def wget(url, out_name=None, out_dir=None, ftp_proxy=None, http_proxy=None, md5=None, segments=4):
     """
-    Download a file from an URL to a local storage using wget
+    Download a file from an URL to a local storage. Return the path of the downloaded file or None if the
+    download failed. See download for the details
     *  url
         A internet URL pointing to the file to download
     *  out_name
@@ -1115,22 +2911,254 @@ def wget(url, out_name=None, out_dir=None, ftp_proxy=None, http_proxy=None):
         address of ftp proxy to use
     * http_proxy
         address of http proxy to use
+    * md5
+        Expected md5 hex digest of the file (facultative)
+    * segments
+        Maximal number of segments downloaded in parallel
     """
-    cmd_l = []
+    df = download(
+        [url],
+        out_dir=out_dir if out_dir and not out_name else "",
+        out_names=[out_name],
+        md5_list=[md5],
+        threads=1,
+        segments=segments,
+        ftp_proxy=ftp_proxy,
+        http_proxy=http_proxy,
+        progress=False,
+    )
+    result = df.iloc[0]
+    if result["status"] in ("downloaded", "exists"):
+        return result["path"]
+    return None
+
+def download(
+    url_list,
+    out_dir=".",
+    out_names=None,
+    md5_list=None,
+    threads=4,
+    segments=4,
+    resume=True,
+    ftp_proxy=None,
+    http_proxy=None,
+    timeout=60,
+    progress=True,
+):
+    """
+    Download a list of URLs concurrently with a pool of threads. Return a Dataframe with the path, size, md5,
+    status and runtime of each download, in the order of url_list.
+    Files larger than DOWNLOAD_MIN_SEGMENT_SIZE served by a server accepting byte ranges are split in segments
+    downloaded in parallel with HTTP Range requests. Data is written in {path}.part, and the progress of each
+    segment in {path}.part.json, so that interrupted downloads are resumed. The size and, if given, the md5 of
+    the file are verified before it is renamed to its final name. Files already present with the expected size
+    and md5 are not downloaded again.
+    * url_list
+        List of URLs or a single URL
+    * out_dir
+        Directory where the files are written
+    * out_names
+        List of output file names, relative to out_dir, for each URL. By default the name at the end of the URL
+    * md5_list
+        List of expected md5 hex digest for each URL, or None to skip the verification
+    * threads
+        Number of files downloaded at the same time
+    * segments
+        Maximal number of segments downloaded in parallel for each file
+    * resume
+        If True, resume partial downloads from a previous call
+    * ftp_proxy
+        address of ftp proxy to use
+    * http_proxy
+        address of http(s) proxy to use
+    * timeout
+        Timeout of connections in seconds
+    * progress
+        Display a progress bar of the downloaded data
+    """
+    if isinstance(url_list, str):
+        url_list = [url_list]
+    out_names = out_names if out_names else [None] * len(url_list)
+    md5_list = md5_list if md5_list else [None] * len(url_list)
+
+    proxy_dict = {}
     if ftp_proxy:
-        cmd_l.append(f"export ftp_proxy={ftp_proxy} &&")
+        proxy_dict["ftp"] = ftp_proxy
     if http_proxy:
-        cmd_l.append(f"export http_proxy={http_proxy} &&")
+        proxy_dict["http"] = proxy_dict["https"] = http_proxy
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler(proxy_dict))
+
+    result_list = []
+    for url, out_name in zip(url_list, out_names):
+        if not out_name:
+            out_name = os.path.basename(urllib.parse.unquote(urllib.parse.urlparse(url).path)) or "index.html"
+        path = os.path.join(out_dir, out_name)
+        result_list.append(OrderedDict(url=url, path=path, size=None, md5=None, status=None, runtime=None))
+        mkdir(os.path.dirname(path) or ".")
+
+    with tqdm(unit="B", unit_scale=True, desc="Downloaded ", disable=not progress) as pb:
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            future_dict = {}
+            for result, md5 in zip(result_list, md5_list):
+                future = executor.submit(
+                    _download_file, opener, result, md5=md5, segments=segments, resume=resume, timeout=timeout, pb=pb
+                )
+                future_dict[future] = result
 
-    cmd_l.append("wget --no-verbose")
-    if out_name:
-        cmd_l.append(f"-O {out_name}")
-    elif out_dir:
-        cmd_l.append(f"-P {out_dir}")
-    cmd_l.append(url)
+            for future in as_completed(future_dict):
+                result = future_dict[future]
+                try:
+                    future.result()
+                except Exception as E:
+                    result["status"] = "error"
+                    cprint("ERROR: {} not downloaded: {}".format(result["url"], E), color="red")
+
+    return pd.DataFrame(result_list)
+
+def _download_file(opener, result, md5=None, segments=4, resume=True, timeout=60, pb=None):
+    """
+    Download a single URL to result["path"] and fill the result dict
+    """
+    stime = time.time()
+    url = result["url"]
+    path = result["path"]
+    part_fn = path + ".part"
+    state_fn = part_fn + ".json"
+    size, accept_ranges = _remote_file_info(opener, url, timeout=timeout)
+
+    # Skip files already downloaded
+    if os.path.isfile(path) and size is not None and os.path.getsize(path) == size:
+        if not md5 or _file_md5(path) == md5:
+            result.update(size=size, md5=md5, status="exists", runtime=round(time.time() - stime, 3))
+            return result
+
+    # Reuse the state of a previous partial download of the same remote file
+    state = None
+    if resume and os.path.isfile(part_fn) and os.path.isfile(state_fn):
+        with open(state_fn) as fp:
+            state = json.load(fp)
+        if state["url"] != url or state["size"] != size or (len(state["segments"]) > 1 and not accept_ranges):
+            state = None
+
+    if state is None:
+        n_segments = 1
+        if size and accept_ranges:
+            n_segments = int(max(1, min(segments, size // DOWNLOAD_MIN_SEGMENT_SIZE)))
+        bounds = [size * i // n_segments for i in range(n_segments + 1)] if size else [0, None]
+        # Each segment is [start, end, position of the next byte to download]
+        state = {"url": url, "size": size, "segments": [[b, e, b] for b, e in zip(bounds[:-1], bounds[1:])]}
+        with open(part_fn, "wb") as fp:
+            if size:
+                fp.truncate(size)
+    if pb is not None:
+        pb.update(sum(pos - start for start, end, pos in state["segments"]))
+
+    lock = threading.Lock()
+    fd = os.open(part_fn, os.O_WRONLY)
+    try:
+        if len(state["segments"]) == 1:
+            _download_segment(opener, url, fd, state["segments"][0], state, state_fn, lock, accept_ranges, timeout, pb)
+        else:
+            with ThreadPoolExecutor(max_workers=len(state["segments"])) as executor:
+                future_list = [
+                    executor.submit(
+                        _download_segment, opener, url, fd, seg, state, state_fn, lock, accept_ranges, timeout, pb
+                    )
+                    for seg in state["segments"]
+                ]
+                for future in future_list:
+                    future.result()
+    finally:
+        os.close(fd)
+        with lock:
+            _save_download_state(state, state_fn)
+
+    # Verify the file before giving it its final name
+    file_size = os.path.getsize(part_fn)
+    if size is not None and file_size != size:
+        raise IOError(f"Size of the downloaded file ({file_size}) differs from the remote size ({size})")
+    if md5:
+        file_md5 = _file_md5(part_fn)
+        if file_md5 != md5:
+            os.remove(part_fn)
+            os.remove(state_fn)
+            raise IOError(f"md5 of the downloaded file ({file_md5}) differs from the expected md5 ({md5})")
+    os.replace(part_fn, path)
+    os.remove(state_fn)
+    result.update(size=file_size, md5=md5, status="downloaded", runtime=round(time.time() - stime, 3))
+    return result
+
+def _download_segment(opener, url, fd, seg, state, state_fn, lock, accept_ranges=False, timeout=60, pb=None):
+    """
+    Download the remaining bytes of a segment and write them at their offset in the file descriptor
+    """
+    start, end, pos = seg
+    if end is not None and pos >= end:
+        return
+
+    request = urllib.request.Request(url)
+    if pos > start or (accept_ranges and end is not None and end - start != state["size"]):
+        request.add_header("Range", "bytes={}-{}".format(pos, end - 1 if end is not None else ""))
+    with opener.open(request, timeout=timeout) as response:
+        # The server ignored the range request and sends the whole file
+        if request.has_header("Range") and getattr(response, "status", 206) != 206:
+            if start != 0 or end != state["size"]:
+                raise IOError("The server does not support range requests")
+            if pb is not None:
+                pb.update(start - pos)
+            pos = start
+
+        n_chunks = 0
+        while end is None or pos < end:
+            chunk = response.read(BUF_SIZE if end is None else min(BUF_SIZE, end - pos))
+            if not chunk:
+                break
+            os.pwrite(fd, chunk, pos)
+            pos += len(chunk)
+            seg[2] = pos
+            if pb is not None:
+                pb.update(len(chunk))
+            n_chunks += 1
+            if n_chunks % 16 == 0:
+                with lock:
+                    _save_download_state(state, state_fn)
+
+    if end is not None and pos < end:
+        raise IOError(f"Connection closed after {pos} bytes, before the end of the segment ({end} bytes)")
+
+def _remote_file_info(opener, url, timeout=60):
+    """
+    Return the size of a remote file, or None if unknown, and whether the server accepts byte ranges
+    """
+    if not url.lower().startswith(("http://", "https://")):
+        return None, False
+    try:
+        with opener.open(urllib.request.Request(url, method="HEAD"), timeout=timeout) as response:
+            size = response.headers.get("Content-Length")
+            accept_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+            return (int(size) if size is not None else None), accept_ranges
+    except urllib.error.HTTPError as E:
+        # Some servers do not implement HEAD, the size is then read from the GET response
+        if E.code in (403, 405, 501):
+            return None, False
+        raise
+
+def _save_download_state(state, state_fn):
+    """
+    Write the progress of a download in its json state file
+    """
+    with open(state_fn, "w") as fp:
+        json.dump(state, fp)
 
-    cmd = " ".join(cmd_l)
-    bash(cmd)
+def _file_md5(fp):
+    """
+    Return the md5 hex digest of a file
+    """
+    md5 = hashlib.md5()
+    with open(fp, "rb") as fh:
+        for chunk in iter(lambda: fh.read(BUF_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 ##~~~~~~~ FUNCTIONS TOOLS ~~~~~~~#
 
@@ -1504,35 +3532,786 @@ def kmer_content(seq_list, min_kmer=3, max_kmer=9, figsize=(10, 2), yscale="log"
 
 ##~~~~~~~ MISC TOOLS ~~~~~~~#
 
-def bam_align_summary(fp, min_mapq=30):
+def bam_align_summary(
+    fp,
+    min_mapq=30,
+    processes=1,
+    threads=1,
+    index_only=False,
+    cache_fn=None,
+    histograms=False,
+    sample=None,
+):
     """
     Parse bam files and return a summary dataframe
     * fp
         file path to a bam file or regular expression matching multiple files
     * min_mapq
         minimal score to be considered high mapq
+    * processes
+        Number of bam files, or contigs of indexed bam files, parsed in parallel
+    * threads
+        Number of decompression threads used by pysam in each process
+    * index_only
+        If True only return the mapped and unmapped read counts from the bam index, without parsing the reads.
+        Mapped counts include secondary and supplementary alignments
+    * cache_fn
+        Path of a json file used as a persistent result cache. Only new or modified bam files (based on path,
+        size and modification time) are parsed for a given min_mapq. Hit and miss counts are available in the
+        "cache_stats" entry of the dataframe attrs
+    * histograms
+        If True, also collect distributions of the primary alignments in the same pass and return a tuple
+        (dataframe, dict of histograms per bam label). Each entry contains:
+        mapq: read count per MAPQ value (0-255)
+        read_len / read_len_bases: read and base counts in log-scaled read length bins (READ_LEN_BIN_EDGES)
+        read_len_n50: read length N50 approximated to the lower edge of its bin
+        ref_primary: pandas Series of primary read counts per reference
+        soft_clip: total number of soft clipped bases
+    * sample
+        If given, fast estimation mode reading only about this number of BGZF blocks spread uniformly across
+        each file. Counts are extrapolated from the compressed size, and the dataframe has (label, estimate /
+        ci_low / ci_high) columns with a 95% bootstrap confidence interval, NaN if fewer than SAMPLE_MIN_RUNS
+        positions could be sampled. Other options are ignored.
+        Reads clustered in a small part of the file, such as unplaced unmapped reads at the end of sorted files,
+        are poorly estimated
     """
     counter_dict = defaultdict(Counter)
-    for bam in glob.glob(fp):
-
+    hist_dict = OrderedDict()
+    bam_list = sorted(glob.glob(fp))
+
+    if sample:
+        est_list = []
+        for bam in bam_list:
+            label = bam.split("/")[-1].split(".")[0]
+            cprint("Sample bam {}".format(label))
+            with ps.AlignmentFile(bam, "rb") as f:
+                n_ref = f.nreferences
+                # Compressed offset of the first alignment, after the header
+                start = f.tell() >> 16
+            est = _bgzf_sample_estimate(bam, sample, start, _bam_sample_parser(n_ref, min_mapq))
+            est_list.append((label, est))
+        return _estimate_df(est_list)
+
+    if index_only:
+        for bam in bam_list:
+            label = bam.split("/")[-1].split(".")[0]
+            with ps.AlignmentFile(bam, "rb") as f:
+                for stats in f.get_index_statistics():
+                    counter_dict[label]["mapped"] += stats.mapped
+                    counter_dict[label]["unmapped"] += stats.unmapped
+                counter_dict[label]["unmapped"] += f.nocoordinate
+        return pd.DataFrame(counter_dict)
+
+    cache = _load_bam_cache(cache_fn) if cache_fn else {}
+    cache_stats = Counter()
+
+    # Split indexed bam files per contig if several processes are available
+    task_list = []
+    for bam in bam_list:
         label = bam.split("/")[-1].split(".")[0]
+        if cache_fn:
+            cached = _bam_cache_get(cache, bam, min_mapq, histograms)
+            if cached is not None:
+                cache_stats["hits"] += 1
+                _merge_bam_result(counter_dict, hist_dict, label, cached)
+                continue
+            cache_stats["misses"] += 1
         cprint("Parse bam {}".format(label))
+        task_list.extend((label, bam, contig) for contig in _bam_shards(bam, processes))
+
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            future_list = [
+                executor.submit(_bam_summary_worker, bam, contig, min_mapq, threads, histograms)
+                for _, bam, contig in task_list
+            ]
+            result_list = [future.result() for future in future_list]
+    else:
+        result_list = [
+            _bam_summary_worker(bam, contig, min_mapq, threads, histograms)
+            for _, bam, contig in task_list
+        ]
+
+    # Merge shards per bam file
+    bam_result_dict = OrderedDict()
+    for (label, bam, _), result in zip(task_list, result_list):
+        if bam in bam_result_dict:
+            bam_result_dict[bam] = _sum_bam_results(bam_result_dict[bam], result)
+        else:
+            bam_result_dict[bam] = result
+
+    for bam, result in bam_result_dict.items():
+        _merge_bam_result(counter_dict, hist_dict, bam.split("/")[-1].split(".")[0], result)
+
+    # Keep the order of the bam files whether they come from the cache or not
+    label_list = list(OrderedDict.fromkeys(bam.split("/")[-1].split(".")[0] for bam in bam_list))
+    df = pd.DataFrame(counter_dict, columns=label_list)
+    if cache_fn:
+        for bam, result in bam_result_dict.items():
+            _bam_cache_set(cache, bam, min_mapq, result)
+        _save_bam_cache(cache_fn, cache)
+        df.attrs["cache_stats"] = dict(hits=cache_stats["hits"], misses=cache_stats["misses"])
+        cprint("Cache hits: {hits} / misses: {misses}".format(**df.attrs["cache_stats"]))
+
+    if histograms:
+        for hist in hist_dict.values():
+            hist["read_len_n50"] = _hist_n50(hist["read_len_bases"])
+        return df, hist_dict
+    return df
+
+def fastq_summary(fp, sample=None):
+    """
+    Parse fastq files and return a summary dataframe with the number of reads and bases
+    * fp
+        file path to a fastq file or regular expression matching multiple files. Uncompressed or compressed
+    * sample
+        If given, fast estimation mode reading only about this number of 64kB blocks (or BGZF blocks for bgzip
+        files) spread uniformly across each file. Counts are extrapolated from the file size, and the dataframe
+        has (label, estimate / ci_low / ci_high) columns with a 95% bootstrap confidence interval, NaN if fewer
+        than SAMPLE_MIN_RUNS positions could be sampled. Not available for other compressed formats
+    """
+    counter_dict = defaultdict(Counter)
+    est_list = []
+    for fq in sorted(glob.glob(fp)):
+        label = fq.split("/")[-1].split(".")[0]
+        if sample:
+            cprint("Sample fastq {}".format(label))
+            comp = file_compression(fq)
+            if comp not in (None, "bgzf"):
+                raise ValueError("Sampling requires uncompressed or bgzip compressed files")
+            est = _bgzf_sample_estimate(fq, sample, 0, _fastq_sample_parser, bgzf=comp == "bgzf")
+            est_list.append((label, est))
+        else:
+            cprint("Parse fastq {}".format(label))
+            c = counter_dict[label]
+            with open_file(fq, "rb") as fh:
+                for seq in itertools.islice(fh, 1, None, 4):
+                    c["reads"] += 1
+                    c["bases"] += len(seq.rstrip())
+
+    if sample:
+        return _estimate_df(est_list)
+    return pd.DataFrame(counter_dict)
 
-        with ps.AlignmentFile(bam, "rb") as f:
-            for read in f:
-                if read.is_unmapped:
-                    counter_dict[label]["unmapped"] += 1
-                elif read.is_secondary:
-                    counter_dict[label]["secondary"] += 1
-                elif read.is_supplementary:
-                    counter_dict[label]["supplementary"] += 1
-                else:
-                    counter_dict[label]["primary"] += 1
-                    counter_dict[label]["primary bases"] += read.infer_read_length()
-                    if read.mapping_quality >= min_mapq:
-                        counter_dict[label]["primary high mapq"] += 1
+def _estimate_df(est_list):
+    """
+    Convert a list of (label, {metric: (estimate, ci_low, ci_high)}) in a dataframe with (label, stat) columns.
+    Estimates and bounds of files with the same label are summed
+    """
+    d = OrderedDict()
+    for label, est in est_list:
+        for i, stat_name in enumerate(("estimate", "ci_low", "ci_high")):
+            col = d.setdefault((label, stat_name), Counter())
+            for metric, v in est.items():
+                col[metric] += v[i]
+    return pd.DataFrame(d)
+
+def _bgzf_sample_estimate(fp, sample, start, parse_fun, bgzf=True, blocks_per_run=4, n_boot=1000, seed=0):
+    """
+    Read runs of consecutive blocks at uniformly spread positions of a file between start and the end of the
+    file, count the records starting in each run with parse_fun(run, window_len) and extrapolate the counts
+    from the number of bytes sampled. Confidence intervals are obtained by bootstrapping the runs.
+    Small samples are split in runs of fewer blocks to get at least SAMPLE_MIN_RUNS runs. Below that number of
+    runs the confidence interval bounds are NaN. If the sample covers most of the file the whole file is parsed
+    and the counts are exact.
+    Return a dict {metric: (estimate, ci_low, ci_high)}
+    """
+    size = os.path.getsize(fp)
+    end = size - len(BGZF_EOF) if bgzf else size
+    total = max(end - start, 0)
+    block_size = 65536 if bgzf else BUF_SIZE // 16
+    blocks_per_run = max(min(blocks_per_run, sample // SAMPLE_MIN_RUNS), 1)
+    n_runs = max(-(-sample // blocks_per_run), 1)
+
+    comp_list = []
+    count_list = []
+    with open(fp, "rb") as fh:
+        # Exact count if the sample would cover most of the file
+        if n_runs * blocks_per_run * block_size // 2 >= total:
+            run = _SampleRun(fh, start, end, bgzf)
+            while run.add_block():
+                pass
+            c = parse_fun(run, len(run.data))
+            return {k: (v, v, v) for k, v in c.items()}
+
+        prev_end = start
+        for i in range(n_runs):
+            offset = start + int(total * (i + 0.5) / n_runs)
+            if bgzf:
+                offset = _bgzf_find_block(fh, max(offset, prev_end), end)
+            if offset is None or offset < prev_end or offset >= end:
+                continue
+            run = _SampleRun(fh, offset, end, bgzf)
+            for _ in range(blocks_per_run):
+                if not run.add_block():
+                    break
+            window_len = len(run.data)
+            comp_list.append(run.next_offset - offset)
+            prev_end = run.next_offset
+            count_list.append(parse_fun(run, window_len))
+
+    metric_list = list(OrderedDict.fromkeys(k for c in count_list for k in c))
+    if not comp_list:
+        return {}
+    comp_arr = np.array(comp_list, dtype=np.float64)
+    count_arr = np.array([[c[m] for m in metric_list] for c in count_list], dtype=np.float64).reshape(len(comp_list), -1)
+
+    # Ratio estimator and bootstrap over the runs
+    estimate = count_arr.sum(axis=0) / comp_arr.sum() * total
+    if len(comp_arr) < SAMPLE_MIN_RUNS:
+        return {m: (int(round(estimate[i])), np.nan, np.nan) for i, m in enumerate(metric_list)}
+    rng = np.random.default_rng(seed)
+    boot_idx = rng.integers(0, len(comp_arr), size=(n_boot, len(comp_arr)))
+    boot = count_arr[boot_idx].sum(axis=1) / comp_arr[boot_idx].sum(axis=1)[:, None] * total
+    ci_low, ci_high = np.percentile(boot, [2.5, 97.5], axis=0)
+    return {m: (int(round(estimate[i])), int(round(ci_low[i])), int(round(ci_high[i]))) for i, m in enumerate(metric_list)}
+
+class _SampleRun:
+    """
+    Consecutive blocks of a file decompressed on demand. BGZF blocks for bgzip files or raw chunks otherwise
+    """
+    def __init__(self, fh, offset, end, bgzf=True, chunk_size=BUF_SIZE // 16):
+        self.fh = fh
+        self.start = offset
+        self.next_offset = offset
+        self.end = end
+        self.bgzf = bgzf
+        self.chunk_size = chunk_size
+        self.data = bytearray()
+
+    def add_block(self):
+        """
+        Decompress the next block and append it to data. Return False at the end of the file
+        """
+        if self.next_offset >= self.end:
+            return False
+        if self.bgzf:
+            block = _bgzf_read_block(self.fh, self.next_offset)
+            if block is None:
+                return False
+            block_len, block_data = block
+        else:
+            self.fh.seek(self.next_offset)
+            block_data = self.fh.read(min(self.chunk_size, self.end - self.next_offset))
+            block_len = len(block_data)
+            if not block_len:
+                return False
+        self.data += block_data
+        self.next_offset += block_len
+        return True
 
-    return pd.DataFrame(counter_dict)
+    def ensure(self, n):
+        """
+        Decompress blocks until at least n bytes are available. Return False if the end of the file is reached
+        """
+        while len(self.data) < n:
+            if not self.add_block():
+                return False
+        return True
+
+def _bgzf_read_block(fh, offset):
+    """
+    Read and decompress the BGZF block starting at offset. Return (compressed size, data) or None if invalid
+    """
+    fh.seek(offset)
+    header = fh.read(18)
+    if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[10:16] != b"\x06\x00BC\x02\x00":
+        return None
+    block_len = struct.unpack("<H", header[16:18])[0] + 1
+    rest = fh.read(block_len - 18)
+    if len(rest) < block_len - 26:
+        return None
+    try:
+        data = zlib.decompress(rest[:-8], -15)
+    except zlib.error:
+        return None
+    crc, isize = struct.unpack("<2I", rest[-8:])
+    if isize != len(data) or crc != zlib.crc32(data):
+        return None
+    return block_len, data
+
+def _bgzf_find_block(fh, offset, end, search_size=2 * 65536):
+    """
+    Return the offset of the first valid BGZF block starting after offset, or None
+    """
+    fh.seek(offset)
+    buf = fh.read(min(search_size, max(end - offset, 0)))
+    i = buf.find(b"\x1f\x8b\x08\x04")
+    while i != -1:
+        if _bgzf_read_block(fh, offset + i):
+            return offset + i
+        i = buf.find(b"\x1f\x8b\x08\x04", i + 1)
+    return None
+
+def _bam_sample_parser(n_ref, min_mapq=30):
+    """
+    Return a function counting the bam records starting in the first window_len bytes of a sample run.
+    Only the fixed part of each record is decoded. Primary bases are estimated from the sequence length
+    """
+    def parse_fun(run, window_len):
+        c = Counter()
+        p = _bam_sync(run, window_len, n_ref)
+        while p < window_len and run.ensure(p + 36):
+            block_size, _, _, _, mapq, _, _, flag, l_seq = struct.unpack_from("<iiiBBHHHi", run.data, p)
+            if flag & 4:
+                c["unmapped"] += 1
+            elif flag & 256:
+                c["secondary"] += 1
+            elif flag & 2048:
+                c["supplementary"] += 1
+            else:
+                c["primary"] += 1
+                c["primary bases"] += l_seq
+                if mapq >= min_mapq:
+                    c["primary high mapq"] += 1
+            p += 4 + block_size
+        for k in ("unmapped", "secondary", "supplementary", "primary", "primary bases", "primary high mapq"):
+            c[k] += 0
+        return c
+    return parse_fun
+
+def _bam_record_valid(run, p, n_ref):
+    """
+    Check if a plausible bam record starts at position p of a sample run
+    """
+    if not run.ensure(p + 36):
+        return False
+    block_size, ref_id, pos, l_read_name, _, _, n_cigar, _, l_seq, next_ref_id, next_pos = struct.unpack_from(
+        "<iiiBBHHHiii", run.data, p
+    )
+    if (
+        not -1 <= ref_id < n_ref
+        or not -1 <= next_ref_id < n_ref
+        or pos < -1
+        or next_pos < -1
+        or l_read_name < 2
+        or l_seq < 0
+        or block_size < 32 + l_read_name + 4 * n_cigar + (l_seq + 1) // 2 + l_seq
+    ):
+        return False
+    if not run.ensure(p + 36 + l_read_name):
+        return False
+    read_name = run.data[p + 36 : p + 36 + l_read_name]
+    return read_name[-1] == 0 and all(33 <= b <= 126 for b in read_name[:-1])
+
+def _bam_sync(run, window_len, n_ref):
+    """
+    Return the position of the first bam record starting in the window of a sample run, validated by the
+    following record if available, or window_len if none is found
+    """
+    for p in range(window_len):
+        if _bam_record_valid(run, p, n_ref):
+            next_p = p + 4 + struct.unpack_from("<i", run.data, p)[0]
+            if not run.ensure(next_p + 36) or _bam_record_valid(run, next_p, n_ref):
+                return p
+    return window_len
+
+def _fastq_sample_parser(run, window_len):
+    """
+    Count the fastq records starting in the first window_len bytes of a sample run
+    """
+    c = Counter(reads=0, bases=0)
+    p = _fastq_sync(run, window_len)
+    while p < window_len:
+        record = _fastq_record(run, p)
+        if not record:
+            break
+        c["reads"] += 1
+        c["bases"] += record[1]
+        p = record[0]
+    return c
+
+def _fastq_record(run, p):
+    """
+    Parse a fastq record starting at position p of a sample run. Return (next record position, sequence length)
+    or None if the record is invalid or incomplete
+    """
+    line_list = []
+    start = p
+    for _ in range(4):
+        while True:
+            nl = run.data.find(b"\n", start)
+            if nl != -1:
+                break
+            if not run.add_block():
+                # Last record of the file without final newline
+                nl = len(run.data)
+                break
+        line_list.append(run.data[start:nl].rstrip(b"\r"))
+        start = nl + 1
+    if (
+        not line_list[0].startswith(b"@")
+        or not line_list[2].startswith(b"+")
+        or len(line_list[1]) != len(line_list[3])
+    ):
+        return None
+    return start, len(line_list[1])
+
+def _fastq_sync(run, window_len):
+    """
+    Return the position of the first fastq record starting in the window of a sample run, validated by the
+    following record if available, or window_len if none is found
+    """
+    # Records can only start at position 0 at the begining of the file
+    p = 0 if run.start == 0 else run.data.find(b"\n@") + 1
+    if not p and run.start:
+        return window_len
+    while p < window_len:
+        record = _fastq_record(run, p)
+        if record and (not run.ensure(record[0] + 1) or _fastq_record(run, record[0])):
+            return p
+        p = run.data.find(b"\n@", p) + 1
+        if not p:
+            break
+    return window_len
+
+def _sum_bam_results(result1, result2):
+    """
+    Sum 2 (Counter, histograms) results of the same bam file
+    """
+    counter = result1[0] + result2[0]
+    if result1[1] is None:
+        return counter, None
+    hist = {k: v if k == "references" else v + result2[1][k] for k, v in result1[1].items()}
+    return counter, hist
+
+def _merge_bam_result(counter_dict, hist_dict, label, result):
+    """
+    Add the (Counter, histograms) result of a bam file to the summary of its label
+    """
+    counter, hist = result
+    counter_dict[label].update(counter)
+    if hist is None:
+        return
+    hist = dict(hist)
+    hist["ref_primary"] = pd.Series(hist.pop("ref_primary"), index=hist.pop("references"), dtype=np.int64)
+    if label in hist_dict:
+        prev = hist_dict[label]
+        for k, v in hist.items():
+            prev[k] = prev[k].add(v, fill_value=0).astype(np.int64) if k == "ref_primary" else prev[k] + v
+    else:
+        hist["read_len_bins"] = READ_LEN_BIN_EDGES
+        hist_dict[label] = hist
+
+def _hist_n50(bases_hist):
+    """
+    Return the lower edge of the read length bin containing the N50 from a histogram of bases per length bin
+    """
+    total = bases_hist.sum()
+    if not total:
+        return 0
+    cum_bases = np.cumsum(bases_hist[::-1])
+    i = len(bases_hist) - 1 - int(np.searchsorted(cum_bases, total / 2))
+    return int(READ_LEN_BIN_EDGES[i])
+
+def _load_bam_cache(cache_fn):
+    """
+    Load a bam_align_summary json cache or return an empty cache
+    """
+    try:
+        with open(cache_fn, "r") as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+def _save_bam_cache(cache_fn, cache):
+    """
+    Atomically write a bam_align_summary json cache
+    """
+    tmp_fn = cache_fn + ".tmp"
+    with open(tmp_fn, "w") as fh:
+        json.dump(cache, fh)
+    os.replace(tmp_fn, cache_fn)
+
+def _bam_cache_get(cache, bam, min_mapq, histograms=False):
+    """
+    Return the cached (Counter, histograms) of a bam file or None if missing or outdated
+    """
+    entry = cache.get(os.path.abspath(bam))
+    st = os.stat(bam)
+    if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+        return None
+    counts = entry["counts"].get(str(min_mapq))
+    if counts is None or (histograms and "hist" not in entry):
+        return None
+    hist = None
+    if histograms:
+        hist = {k: v if k == "references" else np.array(v, dtype=np.int64) for k, v in entry["hist"].items()}
+        hist["soft_clip"] = np.int64(hist["soft_clip"])
+    return Counter(counts), hist
+
+def _bam_cache_set(cache, bam, min_mapq, result):
+    """
+    Store the (Counter, histograms) of a bam file in the cache. Entries of a modified file are discarded
+    """
+    counter, hist = result
+    key = os.path.abspath(bam)
+    st = os.stat(bam)
+    entry = cache.get(key)
+    if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+        entry = cache[key] = {"size": st.st_size, "mtime": st.st_mtime_ns, "counts": {}}
+    entry["counts"][str(min_mapq)] = dict(counter)
+    # Histograms do not depend on min_mapq
+    if hist is not None:
+        entry["hist"] = {k: v if k == "references" else np.asarray(v).tolist() for k, v in hist.items()}
+
+def _bam_shards(bam, processes=1):
+    """
+    Return the list of contigs of an indexed bam containing reads, plus "*" for the unplaced reads,
+    or [None] if the file is not indexed or has to be parsed in a single pass
+    """
+    if processes <= 1:
+        return [None]
+    with ps.AlignmentFile(bam, "rb") as f:
+        if not f.has_index():
+            return [None]
+        return [s.contig for s in f.get_index_statistics() if s.total] + ["*"]
+
+def _bam_summary_worker(bam, contig=None, min_mapq=30, threads=1, histograms=False, batch_size=65536):
+    """
+    Count reads per category in a bam file or in a single contig of an indexed bam file.
+    contig "*" stands for the unplaced unmapped reads, counted from the index.
+    If histograms, primary alignment metrics are buffered in numpy arrays and binned by batches.
+    Return a tuple (Counter, histograms or None)
+    """
+    c = Counter()
+    hist = None
+    with ps.AlignmentFile(bam, "rb", threads=threads) as f:
+        if histograms:
+            hist = {
+                "mapq": np.zeros(256, dtype=np.int64),
+                "read_len": np.zeros(len(READ_LEN_BIN_EDGES) - 1, dtype=np.int64),
+                "read_len_bases": np.zeros(len(READ_LEN_BIN_EDGES) - 1, dtype=np.int64),
+                "ref_primary": np.zeros(f.nreferences, dtype=np.int64),
+                "soft_clip": np.int64(0),
+                "references": list(f.references),
+            }
+            mapq_buf = np.zeros(batch_size, dtype=np.int64)
+            len_buf = np.zeros(batch_size, dtype=np.int64)
+            ref_buf = np.zeros(batch_size, dtype=np.int64)
+            clip_buf = np.zeros(batch_size, dtype=np.int64)
+            n_buf = 0
+
+        if contig == "*":
+            c["unmapped"] += f.nocoordinate
+            return c, hist
+
+        read_iter = f.fetch(contig) if contig else f.fetch(until_eof=True)
+        for read in read_iter:
+            flag = read.flag
+            # Flags 0x4 unmapped, 0x100 secondary and 0x800 supplementary
+            if flag & 4:
+                c["unmapped"] += 1
+            elif flag & 256:
+                c["secondary"] += 1
+            elif flag & 2048:
+                c["supplementary"] += 1
+            else:
+                read_len = read.infer_read_length()
+                mapq = read.mapping_quality
+                c["primary"] += 1
+                c["primary bases"] += read_len
+                if mapq >= min_mapq:
+                    c["primary high mapq"] += 1
+                if histograms:
+                    mapq_buf[n_buf] = mapq
+                    len_buf[n_buf] = read_len
+                    ref_buf[n_buf] = read.reference_id
+                    clip_buf[n_buf] = read.query_length - read.query_alignment_length
+                    n_buf += 1
+                    if n_buf == batch_size:
+                        _add_hist_batch(hist, mapq_buf, len_buf, ref_buf, clip_buf)
+                        n_buf = 0
+
+        if histograms and n_buf:
+            _add_hist_batch(hist, mapq_buf[:n_buf], len_buf[:n_buf], ref_buf[:n_buf], clip_buf[:n_buf])
+    return c, hist
+
+def _add_hist_batch(hist, mapq_arr, len_arr, ref_arr, clip_arr):
+    """
+    Bin a batch of primary alignment metrics in the histogram arrays
+    """
+    n_len_bins = len(hist["read_len"])
+    len_bins = np.clip(np.searchsorted(READ_LEN_BIN_EDGES, len_arr, side="right") - 1, 0, n_len_bins - 1)
+    hist["mapq"] += np.bincount(mapq_arr, minlength=256)
+    hist["read_len"] += np.bincount(len_bins, minlength=n_len_bins)
+    hist["read_len_bases"] += np.bincount(len_bins, weights=len_arr, minlength=n_len_bins).astype(np.int64)
+    hist["ref_primary"] += np.bincount(ref_arr, minlength=len(hist["ref_primary"]))
+    hist["soft_clip"] += clip_arr.sum()
+
+def bam_coverage(
+    fp,
+    window=10000,
+    region_size=10000000,
+    contigs=None,
+    min_mapq=0,
+    exclude_flag=1796,
+    processes=1,
+    threads=1,
+    bedgraph_fn=None,
+):
+    """
+    Compute the mean and median read depth per window of an indexed bam file.
+    The genome is split in regions processed in parallel. Depth is computed from the aligned blocks of each read
+    with numpy difference arrays, without per-base pileup.
+    Return a dataframe with chrom, start, end, mean_depth and median_depth columns
+    * fp
+        Path to an indexed bam file
+    * window
+        Size of the windows in bases
+    * region_size
+        Approximate size of the regions processed by each task. Rounded to a multiple of window
+    * contigs
+        List of contigs to process (Default all)
+    * min_mapq
+        Minimal mapping quality of the reads
+    * exclude_flag
+        Reads with any of these flags are ignored (Default 1796 = unmapped, secondary, qcfail and duplicates)
+    * processes
+        Number of regions processed in parallel
+    * threads
+        Number of decompression threads used by pysam in each process
+    * bedgraph_fn
+        If given, also write the mean depth per window in a bedGraph file
+    """
+    with ps.AlignmentFile(fp, "rb") as f:
+        if not f.has_index():
+            raise ValueError("bam_coverage requires an indexed bam file")
+        contig_len = OrderedDict(zip(f.references, f.lengths))
+
+    if contigs:
+        contig_len = OrderedDict((c, contig_len[c]) for c in contigs)
+
+    region_size = max(region_size // window, 1) * window
+    region_list = [
+        (contig, start, min(start + region_size, length))
+        for contig, length in contig_len.items()
+        for start in range(0, length, region_size)
+    ]
+    args = (window, min_mapq, exclude_flag, threads)
+
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            future_list = [executor.submit(_coverage_worker, fp, *region, *args) for region in region_list]
+            df_list = [future.result() for future in future_list]
+    else:
+        df_list = [_coverage_worker(fp, *region, *args) for region in region_list]
+
+    columns = ["chrom", "start", "end", "mean_depth", "median_depth"]
+    df = pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame(columns=columns)
+
+    if bedgraph_fn:
+        df.to_csv(bedgraph_fn, sep="\t", header=False, index=False, columns=["chrom", "start", "end", "mean_depth"])
+    return df
+
+def _coverage_worker(fp, contig, start, end, window, min_mapq=0, exclude_flag=1796, threads=1):
+    """
+    Compute the depth over a region with a difference array of the aligned blocks and summarize it per window
+    """
+    length = end - start
+    block_start_list = []
+    block_end_list = []
+    with ps.AlignmentFile(fp, "rb", threads=threads) as f:
+        for read in f.fetch(contig, start, end):
+            if read.flag & exclude_flag or read.mapping_quality < min_mapq:
+                continue
+            for block_start, block_end in read.get_blocks():
+                block_start_list.append(block_start)
+                block_end_list.append(block_end)
+
+    # +1 at block starts and -1 at block ends, clipped to the region
+    block_starts = np.clip(np.array(block_start_list, dtype=np.int64) - start, 0, length)
+    block_ends = np.clip(np.array(block_end_list, dtype=np.int64) - start, 0, length)
+    diff = np.bincount(block_starts, minlength=length + 1) - np.bincount(block_ends, minlength=length + 1)
+    depth = np.cumsum(diff[:length])
+
+    win_starts = np.arange(0, length, window)
+    win_ends = np.minimum(win_starts + window, length)
+    mean_depth = np.add.reduceat(depth, win_starts) / (win_ends - win_starts)
+    median_depth = np.empty(len(win_starts))
+    n_full = length // window
+    if n_full:
+        median_depth[:n_full] = np.median(depth[: n_full * window].reshape(n_full, window), axis=1)
+    if n_full < len(win_starts):
+        median_depth[-1] = np.median(depth[n_full * window :])
+
+    return pd.DataFrame(
+        {
+            "chrom": contig,
+            "start": win_starts + start,
+            "end": win_ends + start,
+            "mean_depth": mean_depth,
+            "median_depth": median_depth,
+        }
+    )
+
+def bam_read_chunks(
+    fp,
+    fields=["qname", "flag", "ref", "pos", "mapq", "length"],
+    tags=[],
+    chunk_size=100000,
+    region=None,
+    as_df=True,
+    threads=1,
+):
+    """
+    Generator reading a bam file by chunks of alignments in a columnar format with bounded memory.
+    Only the requested fields are extracted from the alignments in preallocated numpy arrays.
+    Yield pandas dataframes or dicts of numpy arrays
+    * fp
+        Path to a bam file
+    * fields
+        List of fields to extract. Available fields: qname, flag, ref, pos, end, mapq, length, cigar, seq
+    * tags
+        List of optional tags to extract (eg ["NM", "AS"]). Missing tags are set to None
+    * chunk_size
+        Number of alignments per chunk
+    * region
+        If given only parse alignments in this region of an indexed file. samtools style string "chr1:100-200"
+        or tuple (contig, start, end)
+    * as_df
+        If True yield dataframes, else dicts of numpy arrays
+    * threads
+        Number of decompression threads used by pysam
+    """
+    for field in fields:
+        if field not in BAM_FIELDS:
+            raise ValueError("Invalid field {}. Valid fields: {}".format(field, "/".join(BAM_FIELDS)))
+
+    with ps.AlignmentFile(fp, "rb", threads=threads) as f:
+        # Reference ids are converted to names once per chunk. Index -1 (unmapped) points to None
+        references = np.array(list(f.references) + [None], dtype=object)
+
+        if region is None:
+            read_iter = f.fetch(until_eof=True)
+        elif type(region) == str:
+            read_iter = f.fetch(region=region)
+        else:
+            read_iter = f.fetch(*region)
+
+        while True:
+            chunk = {field: np.empty(chunk_size, dtype=BAM_FIELDS[field][1]) for field in fields}
+            chunk.update({tag: np.empty(chunk_size, dtype=object) for tag in tags})
+            getter_list = [(chunk[field], BAM_FIELDS[field][0], BAM_FIELDS[field][2]) for field in fields]
+            tag_list = [(chunk[tag], tag) for tag in tags]
+
+            n = 0
+            for read in itertools.islice(read_iter, chunk_size):
+                for arr, attr, missing in getter_list:
+                    value = getattr(read, attr)
+                    arr[n] = missing if value is None else value
+                for arr, tag in tag_list:
+                    arr[n] = read.get_tag(tag) if read.has_tag(tag) else None
+                n += 1
+
+            if not n:
+                break
+            chunk = {k: v[:n] for k, v in chunk.items()}
+            if "ref" in chunk:
+                chunk["ref"] = references[chunk["ref"]]
+            yield pd.DataFrame(chunk) if as_df else chunk
+            if n < chunk_size:
+                break
 
 class random_seed_gen ():
     def __init__(self, seed=None, skip_previous_seed=False, verbose=False):